@@ -0,0 +1,25 @@
+import datetime
+from django.db import models
+
+
+class Document(models.Model):
+    title = models.CharField(max_length=128)
+    content = models.TextField()
+    author = models.CharField(max_length=64)
+    created = models.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        abstract = True
+
+    def __unicode__(self):
+        return self.title
+
+
+# Several identical models, so draining can be measured across more than one.
+MODEL_COUNT = 4
+document_models = []
+
+for number in range(MODEL_COUNT):
+    model_name = 'Document%d' % number
+    document_models.append(type(model_name, (Document,), {'__module__': __name__}))
+    globals()[model_name] = document_models[-1]
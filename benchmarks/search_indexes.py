@@ -0,0 +1,25 @@
+from haystack import indexes
+from .models import document_models
+
+
+class DocumentIndex(indexes.SearchIndex):
+    text = indexes.CharField(document=True, model_attr='content')
+    title = indexes.CharField(model_attr='title')
+    author = indexes.CharField(model_attr='author')
+    created = indexes.DateTimeField(model_attr='created')
+
+
+def make_index(model):
+    def get_model(self):
+        return model
+
+    index_name = '%sIndex' % model.__name__
+    return type(index_name, (DocumentIndex, indexes.Indexable), {'__module__': __name__, 'get_model': get_model})
+
+
+for model in document_models:
+    index_class = make_index(model)
+    globals()[index_class.__name__] = index_class
+
+# Otherwise haystack finds the last index twice.
+del model, index_class
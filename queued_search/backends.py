@@ -0,0 +1,226 @@
+import re
+import socket
+from django.utils.encoding import force_text
+from haystack.constants import ID
+from haystack.utils import get_identifier
+
+
+def prepare_documents(index, instances):
+    """
+    Prepares instances for indexing, the same way backends do in ``update``.
+
+    ``SearchIndex`` keeps what it's preparing per thread, so workers can
+    prepare with the same index at once.
+    """
+    return [index.full_prepare(instance) for instance in instances]
+
+
+def update_objects(backends, index, instances, documents=None, commit=True):
+    """
+    Sends a batch of instances to one or more Haystack backends.
+
+    The instances are only prepared once, however many backends we know how
+    to send prepared documents to, & not at all if ``documents`` already
+    holds them. Anything else falls back to the backend's own ``update``,
+    which prepares them itself.
+    """
+
+    for backend in backends:
+        sender = get_for_backend(backend, BULK_SENDERS)
+
+        if sender is None:
+            backend.update(index, instances)
+
+            continue
+
+        if documents is None:
+            documents = prepare_documents(index, instances)
+
+        if not documents:
+            continue
+
+        try:
+            sender(backend, index, documents, commit=commit)
+        except Exception as e:
+            if not backend.silently_fail:
+                raise
+
+            backend.log.error("Failed to add %d documents: %s", len(documents), e)
+
+
+def remove_objects(backend, obj_identifiers, commit=True):
+    """
+    Removes many documents from a Haystack backend in one request.
+
+    Backends we know how to delete from by id in bulk get a single
+    delete-by-query. Anything else falls back to removing each document
+    individually, which is what ``SearchIndex.remove_object`` would do.
+    """
+    # Validate them all up front, same as ``backend.remove`` would.
+    doc_ids = [get_identifier(obj_identifier) for obj_identifier in obj_identifiers]
+
+    if not doc_ids:
+        return
+
+    remover = get_for_backend(backend, BULK_REMOVERS)
+
+    if remover is None:
+        for doc_id in doc_ids:
+            backend.remove(doc_id, commit=commit)
+
+        return
+
+    try:
+        remover(backend, doc_ids, commit=commit)
+    except Exception as e:
+        if not backend.silently_fail:
+            raise
+
+        backend.log.error("Failed to remove %d documents: %s", len(doc_ids), e)
+
+
+# What backends say (in one way or another) when they're overloaded, rather
+# than broken. Status codes only count alongside something saying they're
+# one (like ``HTTP 429``, ``status code: 503`` or ``TransportError(429``), so
+# an identifier ending in ``.503`` doesn't.
+OVERLOAD_STATUSES = (429, 503)
+OVERLOAD_PATTERN = re.compile(r'\b(?:HTTP(?:/[0-9.]+)?(?: Error)?|status(?: code)?)\s*:?\s*(?:429|503)\b|Error\((?:429|503)\b|Too Many Requests|Service Unavailable|rejected execution|EsRejectedExecutionException', re.IGNORECASE)
+
+
+def is_overload_error(error):
+    """
+    Whether an error from a backend means it's overloaded & we should back
+    off, rather than that something's wrong with what we sent.
+    """
+    for attr in ('status_code', 'status'):
+        if getattr(error, attr, None) in OVERLOAD_STATUSES:
+            return True
+
+    return OVERLOAD_PATTERN.search(force_text(error)) is not None
+
+
+# The errors (by class name, anywhere in their hierarchy) the clients
+# Haystack's backends use raise when they can't reach the backend.
+TRANSPORT_ERRORS = ('ConnectionError', 'ConnectionTimeout', 'Timeout', 'TimeoutError', 'SSLError')
+
+
+def is_transport_error(error):
+    """
+    Whether an error from a backend means it couldn't be reached (or is
+    overloaded), so sending again later may work, rather than that something's
+    wrong with what we sent.
+    """
+    if isinstance(error, (IOError, OSError, socket.error)):
+        return True
+
+    for klass in type(error).__mro__:
+        if klass.__name__ in TRANSPORT_ERRORS:
+            return True
+
+    return is_overload_error(error)
+
+
+def get_for_backend(backend, registry):
+    """
+    Finds the function for a backend (or any of its parents) in a registry.
+
+    Returns ``None`` if there isn't one.
+    """
+    for klass in type(backend).__mro__:
+        if klass.__name__ in registry:
+            return registry[klass.__name__]
+
+    return None
+
+
+def send_to_solr(backend, index, documents, commit=True):
+    backend.conn.add(documents, commit=commit, boost=index.get_field_weights())
+
+
+def send_to_elasticsearch(backend, index, documents, commit=True):
+    if not backend.setup_complete:
+        backend.setup()
+
+    prepped_docs = []
+
+    for document in documents:
+        final_data = {}
+
+        # Convert the data to make sure it's happy.
+        for key, value in document.items():
+            final_data[key] = backend._from_python(value)
+
+        prepped_docs.append(final_data)
+
+    backend.conn.bulk_index(backend.index_name, 'modelresult', prepped_docs, id_field=ID)
+
+    if commit:
+        backend.conn.refresh(index=backend.index_name)
+
+
+def send_to_whoosh(backend, index, documents, commit=True):
+    from whoosh.writing import AsyncWriter
+
+    if not backend.setup_complete:
+        backend.setup()
+
+    backend.index = backend.index.refresh()
+    writer = AsyncWriter(backend.index)
+
+    for document in documents:
+        doc = {}
+
+        # Really make sure it's unicode, because Whoosh won't have it any
+        # other way.
+        for key, value in document.items():
+            doc[key] = backend._from_python(value)
+
+        # Document boosts aren't supported in Whoosh 2.5.0+.
+        if 'boost' in doc:
+            del doc['boost']
+
+        writer.update_document(**doc)
+
+    # For now, commit no matter what, as we run into locking issues otherwise.
+    writer.commit()
+
+
+def _build_id_query(doc_ids):
+    return u" OR ".join([u'%s:"%s"' % (ID, doc_id) for doc_id in doc_ids])
+
+
+def remove_from_solr(backend, doc_ids, commit=True):
+    backend.conn.delete(q=_build_id_query(doc_ids), commit=commit)
+
+
+def remove_from_elasticsearch(backend, doc_ids, commit=True):
+    if not backend.setup_complete:
+        backend.setup()
+
+    # Documents are stored with their identifier as the ``_id``.
+    query = {'ids': {'values': doc_ids}}
+    backend.conn.delete_by_query(backend.index_name, 'modelresult', query)
+
+    if commit:
+        backend.conn.refresh(index=backend.index_name)
+
+
+def remove_from_whoosh(backend, doc_ids, commit=True):
+    if not backend.setup_complete:
+        backend.setup()
+
+    backend.index = backend.index.refresh()
+    backend.index.delete_by_query(q=backend.parser.parse(_build_id_query(doc_ids)))
+
+
+BULK_SENDERS = {
+    'SolrSearchBackend': send_to_solr,
+    'ElasticsearchSearchBackend': send_to_elasticsearch,
+    'WhooshSearchBackend': send_to_whoosh,
+}
+
+BULK_REMOVERS = {
+    'SolrSearchBackend': remove_from_solr,
+    'ElasticsearchSearchBackend': remove_from_elasticsearch,
+    'WhooshSearchBackend': remove_from_whoosh,
+}
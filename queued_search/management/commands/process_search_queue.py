@@ -1,17 +1,42 @@
+import datetime
+import io
+import json
 import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 from queues import queues, QueueException
+import django
+from django import db
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import models
+from django.db.models import Max, Q
 from django.db.models.loading import get_model
+from django.utils import six, timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.encoding import force_text
 from haystack import connections
 from haystack.constants import DEFAULT_ALIAS
 from haystack.exceptions import NotHandled
-from queued_search.utils import get_queue_name
+from haystack.utils import get_identifier
+from queued_search.backends import is_overload_error, is_transport_error, prepare_documents, remove_objects, update_objects
+from queued_search.messages import build_messages, make_message, pack_messages, parse_message
+from queued_search.metrics import get_metrics
+from queued_search.utils import IdentifierSet, PrefetchingQueue, RateLimiter, get_catch_up_models, get_catch_up_overlap, get_dead_letter_queue_name, get_dependents, get_object_path, get_queue_name, get_queue_name_for, get_queue_partitions, get_queue_routes, split_identifier, write_messages
 
 
 DEFAULT_BATCH_SIZE = None
+DEFAULT_IDLE_BACKOFF = 1.0
+DEFAULT_MAX_IDLE_BACKOFF = 30.0
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 1.0
+DEFAULT_CHECKPOINT_INTERVAL = 10.0
+MAX_ATTEMPTS = getattr(settings, 'SEARCH_QUEUE_MAX_ATTEMPTS', 5)
 LOG_LEVEL = getattr(settings, 'SEARCH_QUEUE_LOG_LEVEL', logging.ERROR)
 
 logging.basicConfig(
@@ -27,7 +52,91 @@ class Command(NoArgsCommand):
             help='Number of items to index at once.'
         ),
         make_option("-u", "--using", action="store", type="string", dest="using", default=DEFAULT_ALIAS,
-            help='If provided, chooses a connection to work with.'
+            help='If provided, chooses a connection to work with. Separate several with commas to write to each of them.'
+        ),
+        make_option('-w', '--window-size', action='store', dest='window_size',
+            default=None, type='int',
+            help='Consume & process the queue in windows of at most this many messages (packed messages count for each identifier they hold).'
+        ),
+        make_option('-t', '--window-time', action='store', dest='window_time',
+            default=None, type='float',
+            help='Consume & process the queue in windows of at most this many seconds.'
+        ),
+        make_option('-d', '--daemon', '--loop', action='store_true', dest='daemon',
+            default=False,
+            help='Keep running & processing the queue until sent SIGTERM.'
+        ),
+        make_option('--idle-backoff', action='store', dest='idle_backoff',
+            default=None, type='float',
+            help='In daemon mode, seconds to wait when the queue is empty. Doubles while idle.'
+        ),
+        make_option('--max-idle-backoff', action='store', dest='max_idle_backoff',
+            default=None, type='float',
+            help='In daemon mode, the most seconds to wait between checks of an empty queue.'
+        ),
+        make_option('--workers', action='store', dest='workers',
+            default=1, type='int',
+            help='Number of workers to spread batches across. Defaults to 1 (no workers).'
+        ),
+        make_option('--worker-type', action='store', dest='worker_type',
+            default='thread', type='choice', choices=['thread', 'process'],
+            help='Whether the workers are threads or (forked) processes. Defaults to "thread".'
+        ),
+        make_option('--prefetch', action='store', dest='prefetch',
+            default=0, type='int',
+            help='Read up to this many messages ahead from each queue in the background, while batches are indexed. Defaults to 0 (off).'
+        ),
+        make_option('--checkpoint', action='store', dest='checkpoint',
+            default=None,
+            help='Save what has been read but not yet indexed to this file as it goes, & pick up from it when starting, so a drain survives being killed.'
+        ),
+        make_option('--checkpoint-interval', action='store', dest='checkpoint_interval',
+            default=DEFAULT_CHECKPOINT_INTERVAL, type='float',
+            help='Seconds between saving checkpoints. Defaults to %s.' % DEFAULT_CHECKPOINT_INTERVAL
+        ),
+        make_option('--catch-up', action='store', dest='catch_up',
+            default=None,
+            help='Index whatever has changed in SEARCH_QUEUE_CATCH_UP_MODELS by their updated field, keeping track of how far each has got in this file.'
+        ),
+        make_option('--catch-up-overlap', action='store', dest='catch_up_overlap',
+            default=None, type='float',
+            help='Seconds before the last change found to look again for changes committed late. Defaults to SEARCH_QUEUE_CATCH_UP_OVERLAP or 5.'
+        ),
+        make_option('--max-documents-per-second', action='store', type='string', dest='max_documents_per_second',
+            default=None,
+            help='Send at most this many documents a second to each connection. Give "alias:rate" pairs, separated by commas, to limit each separately.'
+        ),
+        make_option('--max-requests-per-second', action='store', type='string', dest='max_requests_per_second',
+            default=None,
+            help='Send at most this many bulk requests a second to each connection. Give "alias:rate" pairs, separated by commas, to limit each separately.'
+        ),
+        make_option('--min-age', action='store', dest='min_age',
+            default=None, type='float',
+            help='Hold on to objects until they have been waiting this many seconds, so repeated saves are only indexed once.'
+        ),
+        make_option('--retries', action='store', dest='retries',
+            default=None, type='int',
+            help='Times to retry sending a batch to a backend that can\'t be reached or is overloaded before requeuing it. Defaults to %d.' % DEFAULT_RETRIES
+        ),
+        make_option('--retry-backoff', action='store', dest='retry_backoff',
+            default=None, type='float',
+            help='Seconds to wait before the first retry. Doubles with each retry. Defaults to %s.' % DEFAULT_RETRY_BACKOFF
+        ),
+        make_option('--partition', action='store', type='string', dest='partition',
+            default=None,
+            help='The partition(s) of the queue to process, separated by commas. Defaults to all of them.'
+        ),
+        make_option('--partitions', action='store', dest='partitions',
+            default=None, type='int',
+            help='How many partitions the queue is split into. Defaults to SEARCH_QUEUE_PARTITIONS.'
+        ),
+        make_option('--route', action='store', type='string', dest='route',
+            default=None,
+            help='The route(s) to process the queues of, separated by commas. Defaults to all of them.'
+        ),
+        make_option('--max-attempts', action='store', dest='max_attempts',
+            default=None, type='int',
+            help='Times to attempt an object that keeps failing before dead lettering it. Defaults to %d.' % MAX_ATTEMPTS
         ),
     )
     option_list = NoArgsCommand.option_list + base_options
@@ -35,107 +144,926 @@ class Command(NoArgsCommand):
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
         self.log = logging.getLogger('queued_search')
+        self.shutting_down = False
+        self.local = threading.local()
+        self.pool = None
+        self.resolved = {}
+        self.batchsize = DEFAULT_BATCH_SIZE or 1000
+        self.window_size = None
+        self.retries = DEFAULT_RETRIES
+        self.retry_backoff = DEFAULT_RETRY_BACKOFF
+        self.max_attempts = MAX_ATTEMPTS
+        self.using = DEFAULT_ALIAS
+        self.usings = [DEFAULT_ALIAS]
+        self.workers = 1
+        self.worker_type = 'thread'
+        self.prefetch = 0
+        self.metrics = get_metrics()
+        self.min_age = None
+        self.checkpoint_path = None
+        self.checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL
+        self.checkpointed_at = 0
+        self.catch_up_path = None
+        # The models being caught up, as ``(object_path, index, updated
+        # field)``.
+        self.catch_up_models = []
+        # How far each has been caught up (see ``find_changed``), by model
+        # path. What's been saved to ``--catch-up`` is kept, too.
+        self.catch_up_positions = {}
+        self.catch_up_saved = {}
+        self.catch_up_overlap = get_catch_up_overlap()
+        # When catching up started, for models that haven't been before.
+        self.catch_up_started = None
+        # The pks & updated values found within the overlap of each model's
+        # position, so they're not indexed again each time it's looked at.
+        self.catch_up_recent = {}
+        # The indexes that depend on each model (see ``get_dependents``).
+        self.dependents = None
+        # The document & request rate limiters for each connection, & the
+        # rates they were built from.
+        self.limiters = {}
+        self.max_documents_per_second = None
+        self.max_requests_per_second = None
+        self.partitions = get_queue_partitions()
+        # The routes we're reading from, highest priority first.
+        self.routes = []
+        # Every queue we've opened, by name.
+        self.opened_queues = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Clear out the coalesced messages & what's been processed from them.
+        """
+        # Identifiers are held compactly (see ``IdentifierSet``), as there can
+        # be millions of them.
         self.actions = {
-            'update': set(),
-            'delete': set(),
+            'update': IdentifierSet(),
+            'delete': IdentifierSet(),
         }
-        self.processed_updates = set()
-        self.processed_deletes = set()
+        self.processed_updates = IdentifierSet()
+        self.processed_deletes = IdentifierSet()
+        # Objects whose dependents need updating (see ``handle_cascades``).
+        self.cascades = IdentifierSet()
+        # How many times anything that's failed before has been attempted &
+        # when it was first seen, by identifier.
+        self.attempts = {}
+        # When each identifier was first read, for ``--min-age``.
+        self.seen_at = {}
+        self.window_started = time.time()
 
     def handle_noargs(self, **options):
         self.batchsize = options.get('batchsize', DEFAULT_BATCH_SIZE) or 1000
-        self.using = options.get('using')
-        # Setup the queue.
-        self.queue = queues.Queue(get_queue_name())
+        # The first connection is the one indexes & querysets come from.
+        self.usings = [using.strip() for using in (options.get('using') or DEFAULT_ALIAS).split(',')]
+        self.using = self.usings[0]
+        self.window_size = options.get('window_size')
+        self.window_time = options.get('window_time')
+        self.daemon = options.get('daemon', False)
+        self.idle_backoff = options.get('idle_backoff') or DEFAULT_IDLE_BACKOFF
+        self.max_idle_backoff = options.get('max_idle_backoff') or DEFAULT_MAX_IDLE_BACKOFF
+        self.workers = options.get('workers') or 1
+        self.worker_type = options.get('worker_type') or 'thread'
+        self.prefetch = options.get('prefetch') or 0
+        self.min_age = options.get('min_age')
+        self.checkpoint_path = options.get('checkpoint')
+        self.checkpoint_interval = options.get('checkpoint_interval') or DEFAULT_CHECKPOINT_INTERVAL
+        self.catch_up_path = options.get('catch_up')
+
+        if options.get('catch_up_overlap') is not None:
+            self.catch_up_overlap = options['catch_up_overlap']
+
+        self.max_documents_per_second = options.get('max_documents_per_second')
+        self.max_requests_per_second = options.get('max_requests_per_second')
+        self.limiters = self.setup_limiters(self.max_documents_per_second, self.max_requests_per_second)
+
+        if options.get('retries') is not None:
+            self.retries = options['retries']
+
+        self.retry_backoff = options.get('retry_backoff') or DEFAULT_RETRY_BACKOFF
+        self.max_attempts = options.get('max_attempts') or MAX_ATTEMPTS
+        self.partitions = options.get('partitions') or get_queue_partitions()
+        # Setup the queue(s).
+        self.routes = self.setup_routes(options.get('route'), self.parse_partitions(options.get('partition')))
 
         # Check if enough is there to process.
-        if not len(self.queue):
+        if not sum([len(queue) for route in self.routes for queue in route['queues']]):
             self.log.info("Not enough items in the queue to process.")
 
         self.log.info("Starting to process the queue.")
+        self.resume()
+        self.setup_catch_up()
+        self.start_workers()
+        self.start_prefetching()
 
-        # Consume the whole queue first so that we can group update/deletes
-        # for efficiency.
         try:
-            while True:
-                message = self.queue.read()
+            if self.daemon:
+                self.process_forever()
+            else:
+                self.process_queue()
+        finally:
+            self.stop_prefetching()
+            self.stop_workers()
+            self.metrics.flush()
+
+        self.log.info("Processing complete.")
+
+    def process_queue(self):
+        """
+        Process the queue until it's empty.
+
+        Without a window, this consumes the whole queue first so that we can
+        group update/deletes for efficiency. With one, each window is
+        processed before reading the next, so memory use is bounded by the
+        window rather than by the length of the queue.
+        """
+        while True:
+            exhausted = self.consume()
+
+            if exhausted:
+                self.log.info("Queue consumed.")
+            else:
+                self.log.info("Window consumed.")
+
+            # Once the queue's empty, there's nothing left to wait for.
+            self.flush(force=exhausted)
+
+            if exhausted:
+                break
+
+    def process_forever(self):
+        """
+        Process the queue as messages arrive, until asked to shut down.
+
+        The queue & search connections are kept open between windows. When
+        the queue is empty, waits before checking again, backing off further
+        the longer it stays idle. On SIGTERM (or SIGINT), anything consumed
+        but not yet processed is requeued.
+        """
+        previous_handlers = {}
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            previous_handlers[signum] = signal.signal(signum, self.handle_shutdown)
+
+        backoff = self.idle_backoff
 
-                if not message:
+        try:
+            while not self.shutting_down:
+                exhausted = self.consume()
+
+                if self.shutting_down:
                     break
 
-                self.process_message(message)
-        except QueueException:
-            # We've run out of items in the queue.
-            pass
+                if self.has_mature():
+                    self.flush()
+                    # Don't let the query log grow forever under ``DEBUG``.
+                    db.reset_queries()
+                    backoff = self.idle_backoff
+                elif exhausted:
+                    # Nothing was found to catch up on, but a model may have
+                    # only just started being caught up.
+                    self.save_catch_up()
+                    wait = backoff
+
+                    if self.has_pending():
+                        # Don't wait past when the next object's ready.
+                        wait = min(backoff, self.until_mature())
+
+                    self.log.debug("Queue is empty. Waiting %s seconds.", wait)
+                    self.sleep(wait)
+                    backoff = min(backoff * 2, self.max_idle_backoff)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+        self.log.info("Shutting down.")
+
+        if self.has_pending():
+            self.requeue()
+            self.reset()
+
+    def handle_shutdown(self, signum, frame):
+        """Signal handler that asks the daemon to stop after the current message."""
+        self.log.info("Received signal %d. Stopping...", signum)
+        self.shutting_down = True
+
+    def sleep(self, seconds):
+        """Wait for a while, waking early if asked to shut down."""
+        deadline = time.time() + seconds
+
+        while not self.shutting_down:
+            remaining = deadline - time.time()
+
+            if remaining <= 0:
+                break
+
+            time.sleep(min(remaining, 0.5))
+
+    def has_pending(self):
+        """Whether any consumed messages are waiting to be processed."""
+        return bool(self.actions['update'] or self.actions['delete'] or self.cascades)
+
+    def has_mature(self):
+        """
+        Whether any consumed messages are ready to be processed (given
+        ``--min-age``).
+        """
+        if not self.min_age:
+            return self.has_pending()
+
+        return self.until_mature() <= 0
+
+    def until_mature(self):
+        """
+        Seconds until the next object to be processed has waited for
+        ``--min-age``.
+        """
+        pending = list(self.actions['update']) + list(self.actions['delete']) + list(self.cascades)
+
+        if not pending:
+            return self.min_age or 0
+
+        oldest = min([self.seen_at.get(obj_identifier, 0) for obj_identifier in pending])
+        return oldest + (self.min_age or 0) - time.time()
+
+    def hold_immature(self):
+        """
+        Set aside anything that hasn't waited ``--min-age`` yet, so it isn't
+        processed.
+
+        Returns what was held, to be put back with ``restore``.
+        """
+        held = {'update': set(), 'delete': set()}
+        seen_at = {}
+        attempts = {}
+        now = time.time()
+
+        for action in ('update', 'delete'):
+            for obj_identifier in list(self.actions[action]):
+                if now - self.seen_at.get(obj_identifier, 0) >= self.min_age:
+                    continue
+
+                self.actions[action].remove(obj_identifier)
+                held[action].add(obj_identifier)
+                seen_at[obj_identifier] = self.seen_at[obj_identifier]
+
+                if obj_identifier in self.attempts:
+                    attempts[obj_identifier] = self.attempts[obj_identifier]
+
+        return (held, seen_at, attempts)
+
+    def restore(self, held):
+        """Put back what ``hold_immature`` set aside."""
+        actions, seen_at, attempts = held
+
+        for action in ('update', 'delete'):
+            self.actions[action].update(actions[action])
+
+        self.seen_at.update(seen_at)
+        self.attempts.update(attempts)
+
+    def consume(self):
+        """
+        Read messages off the queue(s) until they're empty or the window is full.
+
+        Returns ``True`` if the queues ran out of messages.
+        """
+        if self.metrics.enabled:
+            for route in self.routes:
+                self.metrics.gauge('queue_depth', sum([len(queue) for queue in route['queues']]), route=route['name'])
+
+        with self.metrics.timer('consume'):
+            seen = 0
+            started = time.time()
+            self.window_started = started
+            exhausted = set()
+            caught_up = True
+
+            if self.catch_up_models:
+                limit = None
+
+                if self.window_size:
+                    # Leave room for the queue, so neither starves the other.
+                    limit = max(self.window_size // 2, 1)
+
+                seen, caught_up = self.catch_up(limit)
+
+            # Highest priority first, each route limited to its share of the
+            # window. Then, if there's room left, top it up from whatever routes
+            # still have messages, still by priority.
+            for capped in (True, False):
+                for route in self.routes:
+                    if route['name'] in exhausted:
+                        continue
+
+                    limit = None
+
+                    if self.window_size:
+                        limit = self.window_size - seen
+
+                        if limit <= 0:
+                            return False
+
+                        if capped and route['share']:
+                            limit = min(limit, max(int(self.window_size * route['share']), 1))
+
+                    read, reason = self.consume_queues(route['queues'], limit, started)
+                    seen += read
+
+                    if reason == 'stopped':
+                        return False
+
+                    if reason == 'empty':
+                        exhausted.add(route['name'])
+
+            return caught_up and len(exhausted) == len(self.routes)
+
+    def consume_queues(self, route_queues, limit, started):
+        """
+        Read messages off a route's queues until they're empty, ``limit``
+        identifiers have been read or the window's over.
+
+        Returns how many were read & why it stopped (``empty``, ``full`` or
+        ``stopped``).
+        """
+        read = 0
+
+        # Start each window on the next partition along, so a busy one
+        # can't starve the rest.
+        route_queues.append(route_queues.pop(0))
+
+        for queue in route_queues:
+            try:
+                while True:
+                    if limit is not None and read >= limit:
+                        return (read, 'full')
+
+                    message = queue.read()
+
+                    if not message:
+                        break
+
+                    # Packed messages count for every identifier they hold.
+                    read += max(self.process_message(message) or 0, 1)
+                    self.metrics.incr('messages_read')
+                    self.checkpoint()
+
+                    if self.shutting_down:
+                        return (read, 'stopped')
+
+                    if self.window_time and time.time() - started >= self.window_time:
+                        return (read, 'stopped')
+            except QueueException:
+                # We've run out of items in this queue.
+                pass
+
+        return (read, 'empty')
+
+    def setup_routes(self, route, partitions):
+        """
+        Works out which routes to process from ``--route``, opening the
+        queues for each of their partitions.
+
+        Returns them highest priority first.
+        """
+        routes = get_queue_routes()
+        names = sorted(routes.keys())
+
+        if route:
+            names = [name.strip() for name in route.split(',')]
+
+            for name in names:
+                if not name in routes:
+                    raise CommandError("Route '%s' doesn't exist. Add it to SEARCH_QUEUE_ROUTES." % name)
+
+        setup = []
+
+        for name in names:
+            setup.append({
+                'name': name,
+                'priority': routes[name]['priority'],
+                'share': routes[name]['share'],
+                'queues': [self.get_queue(get_queue_name(partition, name)) for partition in partitions],
+            })
+
+        setup.sort(key=lambda route: -route['priority'])
+        return setup
+
+    def parse_partitions(self, partition):
+        """
+        Works out which partitions to process from ``--partition``.
+
+        Returns ``[None]`` if the queue isn't partitioned.
+        """
+        if self.partitions <= 1:
+            if partition:
+                raise CommandError("The queue isn't partitioned. Set '--partitions' or SEARCH_QUEUE_PARTITIONS.")
+
+            return [None]
+
+        if not partition:
+            return list(range(self.partitions))
+
+        try:
+            partitions = [int(bit.strip()) for bit in partition.split(',')]
+        except ValueError:
+            raise CommandError("Unable to parse partitions '%s'." % partition)
+
+        for number in partitions:
+            if not 0 <= number < self.partitions:
+                raise CommandError("Partition %d doesn't exist. There are %d (numbered from 0)." % (number, self.partitions))
 
-        self.log.info("Queue consumed.")
+        return partitions
+
+    def get_queue(self, queue_name=None):
+        """
+        Fetch a queue by name (or the plain one), opening it if needed.
+        """
+        if queue_name is None:
+            queue_name = get_queue_name()
+
+        if not queue_name in self.opened_queues:
+            self.opened_queues[queue_name] = queues.Queue(queue_name)
+
+        return self.opened_queues[queue_name]
+
+    def write_back(self, entries):
+        """
+        Put ``(action, identifier, attempts, first_seen)`` entries back on
+        the queue, each on the queue (route & partition) it came from.
+        """
+        by_queue = {}
+
+        for entry in entries:
+            by_queue.setdefault(get_queue_name_for(entry[1], self.partitions), []).append(entry)
+
+        for queue_name, queue_entries in by_queue.items():
+            write_messages(self.get_queue(queue_name), build_messages(queue_entries))
+
+    def flush(self, force=False):
+        """
+        Send everything consumed so far to the search backend.
+
+        With ``--min-age``, anything that hasn't waited long enough is held
+        on to for a later flush, unless ``force`` is given. On failure,
+        anything not yet processed is requeued.
+        """
+        held = None
 
         try:
-            self.handle_updates()
-            self.handle_deletes()
+            with self.metrics.timer('flush'):
+                self.handle_cascades()
+
+                if self.min_age and not force:
+                    held = self.hold_immature()
+
+                self.handle_updates()
+                self.handle_deletes()
         except Exception as e:
-            self.log.error('Exception seen during processing: %s' % e)
+            self.log.error('Exception seen during processing: %s', e)
+
+            if held is not None:
+                self.restore(held)
+
             self.requeue()
             raise e
+        finally:
+            self.metrics.flush()
 
-        self.log.info("Processing complete.")
+        self.reset()
+
+        if held is not None:
+            self.restore(held)
+
+        # Whatever's left (if anything) is all that needs saving now.
+        self.checkpoint(force=True)
+        self.save_catch_up()
 
     def requeue(self):
         """
         On failure, requeue all unprocessed messages.
         """
         self.log.error('Requeuing unprocessed messages.')
-        update_count = 0
-        delete_count = 0
+        entries = self.unprocessed()
+        updates = len([entry for entry in entries if entry[0] == 'update'])
+        deletes = len([entry for entry in entries if entry[0] == 'delete'])
+
+        # Anything that's never failed can go back packed, if we're packing.
+        self.write_back(entries)
+        self.metrics.incr('requeued', len(entries))
+        self.log.error('Requeued %d updates and %d deletes.', updates, deletes)
+
+        # They're back on the queue, so there's nothing to resume from.
+        self.remove_checkpoint()
+
+    def unprocessed(self):
+        """
+        Everything consumed but not yet processed, as ``(action, identifier,
+        attempts, first_seen)`` entries.
+        """
+        entries = []
+
+        for action, processed in (('update', self.processed_updates), ('delete', self.processed_deletes)):
+            for obj_identifier in self.actions[action]:
+                if obj_identifier in processed:
+                    continue
+
+                entries.append((action, obj_identifier) + self.attempts.get(obj_identifier, (0, None)))
+
+        for obj_identifier in self.cascades:
+            entries.append(('cascade', obj_identifier, 0, None))
+
+        return entries
+
+    def checkpoint(self, force=False):
+        """
+        Save everything consumed but not yet processed to ``--checkpoint``,
+        at most every ``--checkpoint-interval`` seconds (unless ``force`` is
+        given).
+
+        Reading the queue is destructive, so this is what lets a drain that's
+        killed part way through pick up where it was (see ``resume``). Some
+        objects may be processed twice, which is harmless.
+        """
+        if not self.checkpoint_path:
+            return
+
+        now = time.time()
+
+        if not force and now - self.checkpointed_at < self.checkpoint_interval:
+            return
+
+        self.checkpointed_at = now
+        entries = self.unprocessed()
+        messages = []
+
+        # Anything read ahead, but not handed out yet, is as good as consumed.
+        for route in self.routes:
+            for queue in route['queues']:
+                if isinstance(queue, PrefetchingQueue):
+                    messages.extend(queue.buffered())
+
+        if not entries and not messages:
+            self.remove_checkpoint()
+            return
+
+        fresh = []
+
+        for action, obj_identifier, attempts, first_seen in entries:
+            if attempts:
+                messages.append(make_message(action, obj_identifier, attempts, first_seen))
+            else:
+                fresh.append((action, obj_identifier))
+
+        messages.extend(pack_messages(fresh))
+        # Written to the side & moved into place, so a checkpoint's never
+        # half written.
+        temp_path = '%s.tmp' % self.checkpoint_path
+
+        with io.open(temp_path, 'w', encoding='utf-8') as checkpoint_file:
+            for message in messages:
+                checkpoint_file.write(force_text(message) + u'\n')
+
+        os.rename(temp_path, self.checkpoint_path)
+        self.log.debug("Checkpointed %d objects.", len(entries))
+
+    def remove_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def resume(self):
+        """
+        Pick up whatever a previous run had consumed but not processed, from
+        ``--checkpoint``.
+        """
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return
+
+        resumed = 0
+
+        with io.open(self.checkpoint_path, encoding='utf-8') as checkpoint_file:
+            for line in checkpoint_file:
+                if line.strip():
+                    resumed += self.process_message(line.strip())
+
+        self.log.info("Resumed %d objects from '%s'.", resumed, self.checkpoint_path)
+
+    def setup_catch_up(self):
+        """
+        Work out which models to catch up (& how far each has got), if
+        ``--catch-up`` was given.
+        """
+        self.catch_up_models = []
+
+        if not self.catch_up_path:
+            return
+
+        for object_path in get_catch_up_models():
+            model_class, current_index = self.resolve(object_path)
+
+            if not current_index:
+                self.log.error("Skipping.")
+                continue
+
+            updated_field = current_index.get_updated_field()
+
+            if not updated_field:
+                self.log.error("The index for '%s' has no updated field, so it can't be caught up. Skipping.", object_path)
+                continue
+
+            self.catch_up_models.append((object_path, current_index, updated_field))
+
+        self.catch_up_started = timezone.now()
+        self.catch_up_positions = self.load_catch_up()
+        self.catch_up_saved = dict(self.catch_up_positions)
+
+    def catch_up(self, limit=None):
+        """
+        Add updates for whatever's changed in the caught up models since they
+        were last caught up, going by each index's updated field.
+
+        Changed rows are found a batch at a time, in order, each batch picking
+        up where the last left off. First, though, the ``--catch-up-overlap``
+        seconds before where it left off are looked at again, for rows whose
+        change was committed after later ones were found (see
+        ``find_late``). Returns how many were found & whether every model's
+        caught up (rather than ``limit`` running out).
+        """
+        found = 0
+
+        for object_path, current_index, updated_field in self.catch_up_models:
+            if not object_path in self.catch_up_positions:
+                self.catch_up_positions[object_path] = self.start_catch_up(object_path, current_index, updated_field)
+
+            recent = self.catch_up_recent.setdefault(object_path, {})
+            rows = self.find_late(current_index, updated_field, self.catch_up_positions[object_path], recent)
+
+            for pk, updated in rows:
+                self.process_entry('update', '%s.%s' % (object_path, pk))
+                recent[pk] = updated
+
+            found += len(rows)
+            self.metrics.incr('caught_up', len(rows), model=object_path)
+
+            while True:
+                size = self.batchsize
+
+                if limit is not None:
+                    size = min(size, limit - found)
+
+                    if size <= 0:
+                        self.forget_recent(object_path)
+                        return (found, False)
+
+                rows = self.find_changed(current_index, updated_field, self.catch_up_positions[object_path], size)
+
+                for pk, updated in rows:
+                    self.process_entry('update', '%s.%s' % (object_path, pk))
+                    recent[pk] = updated
+
+                found += len(rows)
+                self.metrics.incr('caught_up', len(rows), model=object_path)
+
+                if rows:
+                    self.catch_up_positions[object_path] = (rows[-1][1], rows[-1][0])
+
+                if len(rows) < size:
+                    break
+
+            self.forget_recent(object_path)
+
+        return (found, True)
+
+    def get_lookback(self, since):
+        """
+        How far back from ``since`` to look again for late changes, or
+        ``None`` if it isn't a date or time (or there's no overlap).
+        """
+        if not self.catch_up_overlap or not isinstance(since, datetime.date):
+            return None
+
+        return since - datetime.timedelta(seconds=self.catch_up_overlap)
+
+    def start_catch_up(self, object_path, index, updated_field):
+        """
+        Where to start catching up a model that's never been caught up before.
+
+        That's from when this command started, less the overlap, so changes
+        made while it was starting up aren't missed. Anything changed before
+        then needs indexing with ``update_index``. If the updated field isn't
+        a date or time, it's from the latest change instead.
+        """
+        queryset = index.index_queryset(using=self.using)
+
+        if not queryset.exists():
+            # Nothing's there yet, so everything that turns up is new.
+            return None
+
+        field = index.get_model()._meta.get_field(updated_field)
+        started = self.get_lookback(self.catch_up_started) or self.catch_up_started
+
+        if isinstance(field, models.DateTimeField):
+            since = started
+        elif isinstance(field, models.DateField):
+            since = started.date()
+        else:
+            since = queryset.aggregate(latest=Max(updated_field))['latest']
+
+        self.log.info("Catching up '%s' from %s. Use update_index for anything changed before then.", object_path, since)
+        return (since, None)
+
+    def find_late(self, index, updated_field, position, recent):
+        """
+        Fetch the pks & updated values of rows changed within the overlap
+        before ``position``, but not found yet.
+
+        A row's updated value is set when it's saved, not when the change is
+        committed, so one that took a while to commit can turn up behind
+        where catching up has already got to. ``recent`` holds the pks &
+        updated values already found, so those aren't indexed again.
+        """
+        if position is None:
+            return []
+
+        since, last_pk = position
+        lookback = self.get_lookback(since)
+
+        if lookback is None:
+            return []
+
+        queryset = index.index_queryset(using=self.using).filter(**{'%s__gte' % updated_field: lookback, '%s__lte' % updated_field: since})
+        rows = queryset.order_by(updated_field, 'pk').values_list('pk', updated_field)
+        return [(pk, updated) for pk, updated in rows if recent.get(pk) != updated]
+
+    def forget_recent(self, object_path):
+        """Forget the rows found that are no longer within the overlap."""
+        position = self.catch_up_positions.get(object_path)
+        lookback = None
+
+        if position is not None:
+            lookback = self.get_lookback(position[0])
+
+        if lookback is None:
+            self.catch_up_recent[object_path] = {}
+            return
+
+        recent = self.catch_up_recent.get(object_path, {})
+        self.catch_up_recent[object_path] = dict([(pk, updated) for pk, updated in recent.items() if updated >= lookback])
+
+    def find_changed(self, index, updated_field, position, size):
+        """
+        Fetch the pks & updated values of up to ``size`` rows changed since
+        ``position``, in order.
+
+        ``position`` is the updated value & pk of the last row found (the pk
+        breaks ties between rows changed at the same moment), the updated
+        value to start from (if the pk is ``None``) or ``None`` to start from
+        the beginning.
+        """
+        queryset = index.index_queryset(using=self.using).exclude(**{'%s__isnull' % updated_field: True})
+
+        if position is not None:
+            since, last_pk = position
+
+            if last_pk is None:
+                queryset = queryset.filter(**{'%s__gte' % updated_field: since})
+            else:
+                queryset = queryset.filter(Q(**{'%s__gt' % updated_field: since}) | Q(**{updated_field: since, 'pk__gt': last_pk}))
+
+        return list(queryset.order_by(updated_field, 'pk').values_list('pk', updated_field)[:size])
+
+    def load_catch_up(self):
+        """Read how far each model's been caught up from ``--catch-up``."""
+        if not os.path.exists(self.catch_up_path):
+            return {}
+
+        with io.open(self.catch_up_path, encoding='utf-8') as catch_up_file:
+            saved = json.loads(catch_up_file.read())
+
+        positions = {}
+
+        for object_path, position in saved.items():
+            if position is not None:
+                since, last_pk = position
 
-        for update in self.actions['update']:
-            if not update in self.processed_updates:
-                self.queue.write('update:%s' % update)
-                update_count += 1
+                if isinstance(since, dict) and 'datetime' in since:
+                    since = parse_datetime(since['datetime'])
+                elif isinstance(since, dict) and 'date' in since:
+                    since = parse_date(since['date'])
 
-        for delete in self.actions['delete']:
-            if not delete in self.processed_deletes:
-                self.queue.write('delete:%s' % delete)
-                delete_count += 1
+                position = (since, last_pk)
 
-        self.log.error('Requeued %d updates and %d deletes.' % (update_count, delete_count))
+            positions[object_path] = position
+
+        return positions
+
+    def save_catch_up(self):
+        """
+        Save how far each model's been caught up to ``--catch-up``, once
+        everything found has been processed.
+        """
+        if not self.catch_up_path or self.catch_up_positions == self.catch_up_saved:
+            return
+
+        if self.has_pending():
+            # Not processed yet, so we'd lose track of them.
+            return
+
+        saved = {}
+
+        for object_path, position in self.catch_up_positions.items():
+            if position is not None:
+                since, last_pk = position
+
+                if isinstance(since, datetime.datetime):
+                    since = {'datetime': since.isoformat()}
+                elif isinstance(since, datetime.date):
+                    since = {'date': since.isoformat()}
+
+                if last_pk is not None and not isinstance(last_pk, six.integer_types):
+                    last_pk = force_text(last_pk)
+
+                position = [since, last_pk]
+
+            saved[object_path] = position
+
+        # Written to the side & moved into place, so it's never half written.
+        temp_path = '%s.tmp' % self.catch_up_path
+
+        with io.open(temp_path, 'w', encoding='utf-8') as catch_up_file:
+            catch_up_file.write(force_text(json.dumps(saved, sort_keys=True)))
+
+        os.rename(temp_path, self.catch_up_path)
+        self.catch_up_saved = dict(self.catch_up_positions)
 
     def process_message(self, message):
         """
         Given a message added by the ``QueuedSearchIndex``, add it to either
         the updates or deletes for processing.
+
+        Returns how many identifiers the message held.
+        """
+        self.log.debug("Processing message '%s'...", message)
+
+        try:
+            entries = parse_message(message)
+        except ValueError:
+            self.log.error("Unable to parse message '%s'. Moving on...", message)
+            self.metrics.incr('unparseable')
+            return 0
+
+        # A packed message holds many of them.
+        for action, obj_identifier, attempts, first_seen in entries:
+            self.process_entry(action, obj_identifier, attempts, first_seen)
+
+        return len(entries)
+
+    def process_entry(self, action, obj_identifier, attempts=0, first_seen=None):
+        """
+        Add a single action on an object to either the updates or deletes.
         """
-        self.log.debug("Processing message '%s'..." % message)
+        self.log.debug("Saw '%s' on '%s'...", action, obj_identifier)
+        # Split up once, rather than for each lookup.
+        key = split_identifier(obj_identifier)
 
-        if not ':' in message:
-            self.log.error("Unable to parse message '%s'. Moving on..." % message)
+        if action == 'cascade':
+            # About an object others depend on, rather than a document.
+            self.cascades.add(key)
+            self.log.debug("Added '%s' to the cascade list.", obj_identifier)
             return
 
-        action, obj_identifier = message.split(':')
-        self.log.debug("Saw '%s' on '%s'..." % (action, obj_identifier))
+        if key in self.actions['update'] or key in self.actions['delete']:
+            self.metrics.incr('coalesced')
+
+        if self.min_age and not obj_identifier in self.seen_at:
+            self.seen_at[obj_identifier] = time.time()
 
         if action == 'update':
             # Remove it from the delete list if it's present.
             # Since we process the queue in order, this could occur if an
             # object was deleted then readded, in which case we should ignore
             # the delete and just update the index.
-            if obj_identifier in self.actions['delete']:
-                self.actions['delete'].remove(obj_identifier)
-
-            self.actions['update'].add(obj_identifier)
-            self.log.debug("Added '%s' to the update list." % obj_identifier)
+            self.actions['delete'].discard(key)
+            self.actions['update'].add(key)
+            self.log.debug("Added '%s' to the update list.", obj_identifier)
         elif action == 'delete':
             # Remove it from the update list if it's present.
             # Since we process the queue in order, this could occur if an
             # object was updated then deleted, in which case we should ignore
             # the update and just delete the document from the index.
-            if obj_identifier in self.actions['update']:
-                self.actions['update'].remove(obj_identifier)
+            self.actions['update'].discard(key)
+            self.actions['delete'].add(key)
+            self.log.debug("Added '%s' to the delete list.", obj_identifier)
+        else:
+            self.log.error("Unrecognized action '%s'. Moving on...", action)
+            return
 
-            self.actions['delete'].add(obj_identifier)
-            self.log.debug("Added '%s' to the delete list." % obj_identifier)
+        # Keep track of anything that's failed before. A message without any
+        # attempts is from a fresh change, so the object gets a fresh start.
+        if attempts:
+            self.attempts[obj_identifier] = (attempts, first_seen)
         else:
-            self.log.error("Unrecognized action '%s'. Moving on..." % action)
+            self.attempts.pop(obj_identifier, None)
 
     def split_obj_identifier(self, obj_identifier):
         """
@@ -146,7 +1074,7 @@ class Command(NoArgsCommand):
         bits = obj_identifier.split('.')
 
         if len(bits) < 2:
-            self.log.error("Unable to parse object identifer '%s'. Moving on..." % obj_identifier)
+            self.log.error("Unable to parse object identifer '%s'. Moving on...", obj_identifier)
             return (None, None)
 
         pk = bits[-1]
@@ -162,90 +1090,181 @@ class Command(NoArgsCommand):
         model_class = get_model(app_name, classname)
 
         if model_class is None:
-            self.log.error("Could not load model from '%s'. Moving on..." % object_path)
+            self.log.error("Could not load model from '%s'. Moving on...", object_path)
             return None
 
         return model_class
 
-    def get_instance(self, model_class, pk):
-        """Fetch the instance in a standarized way."""
-        try:
-            instance = model_class.objects.get(pk=pk)
-        except ObjectDoesNotExist:
-            self.log.error("Couldn't load model instance with pk #%s. Somehow it went missing?" % pk)
-            return None
-        except MultipleObjectsReturned:
-            self.log.error("More than one object with pk #%s. Oops?" % pk)
-            return None
+    def resolve(self, object_path):
+        """
+        Fetch the model class & ``SearchIndex`` for an object path.
 
-        return instance
+        Results, including failures, are cached for the life of the command
+        (so across windows in daemon mode), meaning unknown models & unhandled
+        indexes only get looked up & logged once.
+        """
+        if not object_path in self.resolved:
+            model_class = self.get_model_class(object_path)
+            current_index = None
+
+            if model_class is not None:
+                current_index = self.get_index(model_class)
+
+            self.resolved[object_path] = (model_class, current_index)
+
+        return self.resolved[object_path]
+
+    def get_instances(self, index, pks):
+        """
+        Fetch a batch of instances in a single query.
+
+        Uses the index's ``index_queryset`` so that any ``select_related`` or
+        ``prefetch_related`` it defines applies to the batch. Any pks that
+        don't come back are logged & skipped.
+        """
+        queryset = index.index_queryset(using=self.using).filter(pk__in=pks)
+        instances = list(queryset)
+        found = set([force_text(instance.pk) for instance in instances])
+
+        for pk in pks:
+            if not force_text(pk) in found:
+                self.log.error("Couldn't load model instance with pk #%s. Somehow it went missing?", pk)
+
+        return instances
 
     def get_index(self, model_class):
         """Fetch the model's registered ``SearchIndex`` in a standarized way."""
         try:
-            return connections['default'].get_unified_index().get_index(model_class)
+            return connections[self.using].get_unified_index().get_index(model_class)
         except NotHandled:
-            self.log.error("Couldn't find a SearchIndex for %s." % model_class)
+            self.log.error("Couldn't find a SearchIndex for %s.", model_class)
             return None
 
-    def handle_updates(self):
+    def handle_cascades(self):
         """
-        Process through all updates.
+        Turn cascades into updates for the objects that depend on them, by
+        the indexes' ``dependency_paths``.
 
-        Updates are grouped by model class for maximum batching/minimized
-        merging.
+        There's a query per dependent index & path, for every object of a
+        model at once (a batch at a time). Anything already being updated or
+        deleted is left as it is, so however many objects a change reaches,
+        each is only updated once.
+
+        With ``--window-size``, no more are added than there's room left for
+        in the window. The rest are requeued as updates, a batch at a time,
+        for later windows, so one change reaching a great many objects can't
+        blow the window (or memory) out.
         """
-        # For grouping same model classes for efficiency.
-        updates = {}
-        previous_path = None
-        current_index = None
+        if not self.cascades:
+            return
+
+        if self.dependents is None:
+            self.dependents = get_dependents(connections[self.using].get_unified_index())
+
+        room = None
+        requeued = 0
+        overflow = []
 
-        for obj_identifier in self.actions['update']:
-            (object_path, pk) = self.split_obj_identifier(obj_identifier)
+        if self.window_size:
+            room = max(self.window_size - len(self.actions['update']) - len(self.actions['delete']), 0)
 
-            if object_path is None or pk is None:
+        for object_path in self.cascades.object_paths():
+            model_class = self.get_model_class(object_path)
+
+            if model_class is None:
                 self.log.error("Skipping.")
                 continue
 
-            if object_path not in updates:
-                updates[object_path] = []
+            pks = list(self.cascades.pks(object_path))
 
-            updates[object_path].append(pk)
+            for index, path in self.dependents.get(model_class, []):
+                dependent_path = get_object_path(index.get_model())
+                cascaded = 0
 
-        # We've got all updates grouped. Process them.
-        for object_path, pks in updates.items():
-            model_class = self.get_model_class(object_path)
+                for start in range(0, len(pks), self.batchsize):
+                    queryset = index.index_queryset(using=self.using).filter(**{'%s__pk__in' % path: pks[start:start + self.batchsize]})
 
-            if object_path != previous_path:
-                previous_path = object_path
-                current_index = self.get_index(model_class)
+                    for pk in queryset.values_list('pk', flat=True).iterator():
+                        obj_identifier = '%s.%s' % (dependent_path, pk)
+                        key = split_identifier(obj_identifier)
+
+                        if key in self.actions['update'] or key in self.actions['delete']:
+                            continue
+
+                        if room is not None and cascaded >= room:
+                            overflow.append(('update', obj_identifier, 0, None))
+
+                            if len(overflow) >= self.batchsize:
+                                self.write_back(overflow)
+                                requeued += len(overflow)
+                                overflow = []
+
+                            continue
+
+                        self.process_entry('update', obj_identifier)
+                        cascaded += 1
+
+                if room is not None:
+                    room -= cascaded
+
+                self.log.debug("Cascaded changes to %d %s from %d %s.", cascaded, dependent_path, len(pks), object_path)
+                self.metrics.incr('cascaded', cascaded, model=dependent_path)
+
+        if overflow:
+            self.write_back(overflow)
+            requeued += len(overflow)
+
+        if requeued:
+            self.log.info("Requeued %d cascaded updates that didn't fit in the window.", requeued)
+            self.metrics.incr('requeued', requeued)
+
+        self.cascades.clear()
+
+    def handle_updates(self):
+        """
+        Process through all updates.
+
+        Updates are grouped by model class for maximum batching/minimized
+        merging.
+        """
+        # They're already grouped by model class (see ``IdentifierSet``).
+        updates = self.actions['update']
+
+        for obj_identifier in updates.unparseable():
+            self.split_obj_identifier(obj_identifier)
+            self.log.error("Skipping.")
+
+        # Batch them up.
+        handled = []
+        tasks = []
+
+        for object_path in updates.object_paths():
+            pks = list(updates.pks(object_path))
+            model_class, current_index = self.resolve(object_path)
 
             if not current_index:
                 self.log.error("Skipping.")
                 continue
 
-            instances = [self.get_instance(model_class, pk) for pk in pks]
-
-            # Filter out what we didn't find.
-            instances = [instance for instance in instances if instance is not None]
-
-            # Update the batch of instances for this class.
-            # Use the backend instead of the index because we can batch the
-            # instances.
-            total = len(instances)
-            self.log.debug("Indexing %d %s." % (total, object_path))
+            # Instances are fetched & indexed a batch at a time, so that we
+            # neither hit the database once per pk nor hold every instance
+            # in memory.
+            total = len(pks)
+            self.log.debug("Indexing %d %s.", total, object_path)
 
             for start in range(0, total, self.batchsize):
                 end = min(start + self.batchsize, total)
-                batch_instances = instances[start:end]
+                tasks.append(('update', object_path, pks[start:end], start, total))
+
+            handled.append(object_path)
 
-                self.log.debug("  indexing %s - %d of %d." % (start+1, end, total))
-                current_index._get_backend(self.using).update(current_index, batch_instances)
+        self.run_tasks(tasks)
 
-                for updated in batch_instances:
-                    self.processed_updates.add("%s.%s" % (object_path, updated.pk))
+        if not self.log.isEnabledFor(logging.DEBUG):
+            return
 
-            self.log.debug("Updated objects for '%s': %s" % (object_path, ", ".join(pks)))
+        for object_path in handled:
+            self.log.debug("Updated objects for '%s': %s", object_path, ", ".join([force_text(pk) for pk in updates.pks(object_path)]))
 
     def handle_deletes(self):
         """
@@ -253,39 +1272,547 @@ class Command(NoArgsCommand):
 
         Deletes are grouped by model class for maximum batching.
         """
-        deletes = {}
-        previous_path = None
-        current_index = None
+        deletes = self.actions['delete']
+
+        for obj_identifier in deletes.unparseable():
+            self.split_obj_identifier(obj_identifier)
+            self.log.error("Skipping.")
 
-        for obj_identifier in self.actions['delete']:
-            (object_path, pk) = self.split_obj_identifier(obj_identifier)
+        # Batch them up.
+        handled = []
+        tasks = []
 
-            if object_path is None or pk is None:
+        for object_path in deletes.object_paths():
+            obj_identifiers = [deletes.join(object_path, pk) for pk in deletes.pks(object_path)]
+            model_class, current_index = self.resolve(object_path)
+
+            if not current_index:
                 self.log.error("Skipping.")
                 continue
 
-            if object_path not in deletes:
-                deletes[object_path] = []
+            # Remove the documents a batch at a time, rather than making a
+            # request per document.
+            total = len(obj_identifiers)
 
-            deletes[object_path].append(obj_identifier)
+            for start in range(0, total, self.batchsize):
+                end = min(start + self.batchsize, total)
+                tasks.append(('delete', object_path, obj_identifiers[start:end], start, total))
 
-        # We've got all deletes grouped. Process them.
-        for object_path, obj_identifiers in deletes.items():
-            model_class = self.get_model_class(object_path)
+            handled.append(object_path)
 
-            if object_path != previous_path:
-                previous_path = object_path
-                current_index = self.get_index(model_class)
+        self.run_tasks(tasks)
 
-            if not current_index:
-                self.log.error("Skipping.")
-                continue
+        if not self.log.isEnabledFor(logging.DEBUG):
+            return
+
+        for object_path in handled:
+            self.log.debug("Deleted objects for '%s': %s", object_path, ", ".join([force_text(pk) for pk in deletes.pks(object_path)]))
+
+    def update_batch(self, object_path, pks, start, total):
+        """
+        Index a batch of a model's instances.
+
+        Use the backends instead of the index because we can batch the
+        instances. They're prepared once, then sent to every connection,
+        retrying the sending if need be. Returns the identifiers of what was
+        indexed.
+        """
+        model_class, current_index = self.resolve(object_path)
+
+        with self.metrics.timer('fetch', model=object_path):
+            batch_instances = self.get_instances(current_index, pks)
+
+        self.metrics.incr('fetched', len(batch_instances), model=object_path)
+        self.metrics.incr('missing', len(pks) - len(batch_instances), model=object_path)
+        obj_identifiers = ["%s.%s" % (object_path, instance.pk) for instance in batch_instances]
+
+        with self.metrics.timer('prepare', model=object_path):
+            documents = prepare_documents(current_index, batch_instances)
+
+        self.metrics.incr('prepared', len(documents), model=object_path)
+
+        self.log.debug("  indexing %s - %d of %d.", start+1, start + len(pks), total)
+
+        for using in self.usings:
+            backend = self.get_backend(current_index, using)
+
+            with self.metrics.timer('send', model=object_path):
+                self.retry(update_objects, [backend], current_index, batch_instances, documents, using=using, count=len(documents))
+
+        self.metrics.incr('indexed', len(obj_identifiers), model=object_path)
+        return obj_identifiers
+
+    def delete_batch(self, object_path, obj_identifiers, start, total):
+        """
+        Remove a batch of a model's documents.
+
+        Returns the identifiers of what was removed.
+        """
+        model_class, current_index = self.resolve(object_path)
+
+        # Check the identifiers up front, so bad ones fail straight away
+        # rather than being retried.
+        for obj_identifier in obj_identifiers:
+            get_identifier(obj_identifier)
+
+        with self.metrics.timer('remove', model=object_path):
+            for using in self.usings:
+                self.retry(remove_objects, self.get_backend(current_index, using), obj_identifiers, using=using, count=len(obj_identifiers))
+
+        self.metrics.incr('deleted', len(obj_identifiers), model=object_path)
+        return obj_identifiers
+
+    def retry(self, func, *args, **kwargs):
+        """
+        Call something that talks to the backend, retrying it if the backend
+        couldn't be reached or is overloaded (see ``is_transport_error``).
+
+        Waits ``--retry-backoff`` seconds before the first retry, doubling
+        each time after. Once ``--retries`` is exhausted, the error's raised.
+        Any other error is raised straight away, as it'd only happen again.
+
+        Given the connection (``using``) & how many documents are being sent
+        (``count``), every attempt waits for that connection's rate limits.
+        If the backend says it's overloaded, they're tightened.
+        """
+        using = kwargs.get('using')
+        count = kwargs.get('count', 0)
+        attempt = 0
+
+        while True:
+            self.throttle(using, count)
+
+            try:
+                result = func(*args)
+                self.relax(using)
+                return result
+            except Exception as e:
+                if using is not None and is_overload_error(e):
+                    self.tighten(using)
+
+                if attempt >= self.retries or self.shutting_down or not is_transport_error(e):
+                    raise
+
+                delay = self.retry_backoff * (2 ** attempt)
+                self.metrics.incr('retries')
+                self.log.error("Sending to the backend failed: %s. Retrying in %s seconds.", e, delay)
+                self.sleep(delay)
+                attempt += 1
+
+    def setup_limiters(self, max_documents, max_requests):
+        """
+        Build the rate limiters for each connection, from
+        ``--max-documents-per-second`` & ``--max-requests-per-second``.
+        """
+        documents = self.parse_rates(max_documents)
+        requests = self.parse_rates(max_requests)
+        limiters = {}
+
+        for using in self.usings:
+            limiters[using] = (
+                RateLimiter(documents[using]) if using in documents else None,
+                RateLimiter(requests[using]) if using in requests else None,
+            )
+
+        return limiters
+
+    def parse_rates(self, rates):
+        """
+        Turns ``500`` (for every connection) or ``default:500,shadow:100``
+        into rates by connection.
+        """
+        parsed = {}
+
+        if not rates:
+            return parsed
+
+        try:
+            if not ':' in rates:
+                for using in self.usings:
+                    parsed[using] = float(rates)
+            else:
+                for bit in rates.split(','):
+                    using, rate = bit.split(':')
+                    parsed[using.strip()] = float(rate)
+        except ValueError:
+            raise CommandError("Unable to parse rates '%s'." % rates)
+
+        for using, rate in parsed.items():
+            if rate <= 0:
+                raise CommandError("Rates must be more than 0, not %s for '%s'." % (rate, using))
+
+        return parsed
+
+    def throttle(self, using, count):
+        """Wait until a connection's rate limits allow sending ``count`` documents."""
+        document_limiter, request_limiter = self.limiters.get(using, (None, None))
+
+        if document_limiter is not None and count:
+            document_limiter.acquire(count)
+
+        if request_limiter is not None:
+            request_limiter.acquire()
+
+    def tighten(self, using):
+        """The backend's overloaded, so halve the connection's rate limits."""
+        self.metrics.incr('overloaded', using=using)
+        self.log.error("The backend for '%s' is overloaded. Slowing down.", using)
+
+        for limiter in self.limiters.get(using, (None, None)):
+            if limiter is not None:
+                limiter.slow_down()
+
+    def relax(self, using):
+        """Let the connection's rate limits recover towards their maximum."""
+        for limiter in self.limiters.get(using, (None, None)):
+            if limiter is not None:
+                limiter.speed_up()
+
+    def run_task(self, task):
+        """
+        Run a single batch of work.
+
+        Returns the action & the identifiers that were processed, for the
+        caller to mark as such.
+        """
+        action = task[0]
+
+        if action == 'update':
+            return (action, self.update_batch(*task[1:]))
+
+        return (action, self.delete_batch(*task[1:]))
+
+    def run_tasks(self, tasks):
+        """
+        Run batches of work, spread across the workers if there are any.
+
+        The processed bookkeeping only ever happens here, in the main thread,
+        so the workers don't need to share it. A batch failing doesn't stop
+        the others. Once they've all run, each failed batch has its
+        failure(s) isolated.
+        """
+        failures = []
+
+        if self.pool is None or len(tasks) <= 1:
+            for task in tasks:
+                try:
+                    self.mark_processed(*self.run_task(task))
+                except Exception as e:
+                    failures.append((task, e))
+        else:
+            results = [(task, self.pool.apply_async(self.pool_task, (task,))) for task in tasks]
+
+            for task, result in results:
+                try:
+                    self.mark_processed(*result.get())
+                except Exception as e:
+                    failures.append((task, e))
+
+        for task, error in failures:
+            self.isolate_failures(task, error)
+
+    def isolate_failures(self, task, error):
+        """
+        Work out which object(s) made a batch fail & process the rest.
+
+        If the backend couldn't be reached or is overloaded (see
+        ``is_transport_error``), no object's to blame. The error's raised
+        straight away, whatever the size of the batch, & everything
+        unprocessed requeued without using up any attempts.
+
+        Otherwise, the batch is split in half & each half run again, until
+        the failures are down to single objects. Those are requeued or dead
+        lettered (see ``handle_failures``).
+        """
+        if self.shutting_down or is_transport_error(error):
+            raise error
+
+        self.log.error("Batch of %d failed: %s. Isolating the failure(s)...", len(task[2]), error)
+
+        # The batch as a whole has already been retried.
+        retries = self.retries
+        self.retries = 0
+
+        try:
+            failures = self.bisect(task, error, probe=True)
+        finally:
+            self.retries = retries
+
+        self.handle_failures(task[0], failures)
+
+    def bisect(self, task, error, probe=False):
+        """
+        Run each half of a failed batch, recursing into any half that fails.
+
+        Returns a list of the identifiers that failed, along with their
+        errors. If the backend can't be reached, that error's raised instead.
+
+        With ``probe``, both halves are run before going any further. If
+        both fail just as the whole batch did, the backend's the more likely
+        culprit than the data. So rather than sending about twice as many
+        requests as there are objects to narrow it down, the error's raised
+        (& the batch requeued) with each object's attempts bumped. Once any
+        of them is on its last attempt, it's narrowed down anyway, so a batch
+        that keeps failing ends up dead lettered rather than requeued forever.
+        """
+        action, object_path, items, start, total = task
+
+        if len(items) == 1:
+            return [(self.get_task_identifiers(task)[0], error)]
+
+        middle = len(items) // 2
+        failed = []
+
+        for offset, half in ((0, items[:middle]), (middle, items[middle:])):
+            subtask = (action, object_path, half, start + offset, total)
+
+            try:
+                self.mark_processed(*self.run_task(subtask))
+            except Exception as e:
+                if is_transport_error(e):
+                    raise
+
+                failed.append((subtask, e))
+
+        if probe and len(failed) == 2 and all([self.is_same_failure(e, error) for subtask, e in failed]):
+            if self.count_attempt(task):
+                raise error
+
+        failures = []
+
+        for subtask, e in failed:
+            failures.extend(self.bisect(subtask, e))
+
+        return failures
+
+    def is_same_failure(self, error, other):
+        return type(error) is type(other) and force_text(error) == force_text(other)
+
+    def count_attempt(self, task):
+        """
+        Bump the attempts of every object in a batch that's being requeued
+        as a whole.
+
+        Returns ``False`` (without bumping anything) if any of them is on its
+        last attempt.
+        """
+        obj_identifiers = self.get_task_identifiers(task)
+        counted = []
+
+        for obj_identifier in obj_identifiers:
+            attempts, first_seen = self.attempts.get(obj_identifier, (0, self.window_started))
+
+            if attempts + 1 >= self.max_attempts:
+                return False
+
+            counted.append((obj_identifier, (attempts + 1, first_seen)))
+
+        self.attempts.update(dict(counted))
+        return True
+
+    def get_task_identifiers(self, task):
+        """The identifiers of the objects in a batch."""
+        action, object_path, items = task[:3]
+
+        if action == 'update':
+            return ["%s.%s" % (object_path, pk) for pk in items]
+
+        return list(items)
+
+    def handle_failures(self, action, failures):
+        """
+        Deal with objects that have failed on their own.
+
+        Each is requeued with its attempts bumped, to be tried again on a
+        later run, until it's been attempted ``--max-attempts`` times. Then it
+        goes to the dead letter queue instead. Either way, it's marked as
+        processed.
+        """
+        retries = []
+        dead_letters = []
+
+        for obj_identifier, error in failures:
+            attempts, first_seen = self.attempts.get(obj_identifier, (0, self.window_started))
+            attempts += 1
+
+            if attempts >= self.max_attempts:
+                dead_letters.append((obj_identifier, error, attempts, first_seen))
+            else:
+                self.log.error("Requeuing '%s:%s' after %d of %d attempts: %s", action, obj_identifier, attempts, self.max_attempts, error)
+                retries.append((action, obj_identifier, attempts, first_seen))
+
+        self.metrics.incr('failed', len(failures))
+
+        if retries:
+            self.write_back(retries)
+            self.metrics.incr('requeued', len(retries))
+
+        if dead_letters:
+            self.dead_letter(action, dead_letters)
+
+        self.mark_processed(action, [obj_identifier for obj_identifier, error in failures])
+
+    def dead_letter(self, action, dead_letters):
+        """
+        Send messages that have run out of attempts to the dead letter queue.
+
+        Each is kept with its error, how many times it was attempted & when
+        it was first seen.
+        """
+        messages = []
+
+        for obj_identifier, error, attempts, first_seen in dead_letters:
+            self.log.error("Sending '%s:%s' to the dead letter queue after %d attempts: %s", action, obj_identifier, attempts, error)
+            messages.append(json.dumps({
+                'action': action,
+                'identifier': obj_identifier,
+                'attempts': attempts,
+                'first_seen': first_seen,
+                'error': force_text(error),
+            }))
+
+        write_messages(queues.Queue(get_dead_letter_queue_name()), messages)
+        self.metrics.incr('dead_lettered', len(messages))
+
+    def mark_processed(self, action, obj_identifiers):
+        """
+        Note identifiers as processed, so they won't be requeued (or
+        checkpointed).
+        """
+        if action == 'update':
+            self.processed_updates.update(obj_identifiers)
+        else:
+            self.processed_deletes.update(obj_identifiers)
+
+        self.checkpoint()
+
+    def start_workers(self):
+        """
+        Start the pool of workers batches are fanned out to, if asked for.
+        """
+        self.pool = None
+
+        if self.workers <= 1:
+            return
+
+        if self.worker_type == 'process':
+            # The forked workers mustn't share our database connections. They
+            # each open their own as they need them.
+            for connection in db.connections.all():
+                connection.close()
+
+            self.pool = multiprocessing.Pool(self.workers, init_process_worker, (self.get_worker_options(),))
+            self.pool_task = run_process_task
+        else:
+            self.pool = ThreadPool(self.workers)
+            self.pool_task = self.run_task
+
+    def get_worker_options(self):
+        """
+        What a process worker needs to run batches the way we would.
+
+        Each worker builds a command of its own from these (see
+        ``setup_worker``), rather than being sent this one. It holds locks,
+        queues & threads, so can't be pickled, as it would have to be for
+        workers that aren't forked.
+        """
+        return {
+            'batchsize': self.batchsize,
+            'usings': self.usings,
+            'retries': self.retries,
+            'retry_backoff': self.retry_backoff,
+            'max_documents_per_second': self.max_documents_per_second,
+            'max_requests_per_second': self.max_requests_per_second,
+        }
+
+    def setup_worker(self, options):
+        """Set up a process worker's command, from ``get_worker_options``."""
+        self.batchsize = options['batchsize']
+        self.usings = options['usings']
+        self.using = self.usings[0]
+        self.retries = options['retries']
+        self.retry_backoff = options['retry_backoff']
+        self.max_documents_per_second = options['max_documents_per_second']
+        self.max_requests_per_second = options['max_requests_per_second']
+        self.limiters = self.setup_limiters(self.max_documents_per_second, self.max_requests_per_second)
+
+    def stop_workers(self):
+        """Wait for the workers to finish & shut them down."""
+        if self.pool is None:
+            return
+
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+    def start_prefetching(self):
+        """
+        Start reading ahead from each queue in the background, if asked for.
+        """
+        if self.prefetch <= 0:
+            return
+
+        for route in self.routes:
+            route['queues'] = [PrefetchingQueue(queue, self.prefetch) for queue in route['queues']]
+
+    def stop_prefetching(self):
+        """
+        Stop reading ahead, putting anything read but not yet consumed back
+        on its queue.
+        """
+        written_back = 0
+
+        for route in self.routes:
+            route_queues = []
+
+            for queue in route['queues']:
+                if isinstance(queue, PrefetchingQueue):
+                    written_back += queue.close()
+                    queue = queue.queue
+
+                route_queues.append(queue)
+
+            route['queues'] = route_queues
+
+        if written_back:
+            self.log.info("Wrote back %d prefetched messages.", written_back)
+
+    def get_backend(self, index, using):
+        """
+        Fetch the backend for a connection to send a batch to.
+
+        With workers, each worker thread/process gets its own backend (and
+        so its own connection), rather than sharing Haystack's.
+        """
+        if self.pool is None:
+            return index._get_backend(using)
+
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.pid = os.getpid()
+            self.local.backends = {}
+
+        if not using in self.local.backends:
+            engine = connections[using]
+            self.local.backends[using] = engine.backend(using, **engine.options)
+
+        return self.local.backends[using]
+
+
+# The command a process pool's worker runs its batches with. It's built as
+# the worker starts, rather than being pickled with every batch.
+_worker_command = None
+
+
+def init_process_worker(options):
+    global _worker_command
+
+    if hasattr(django, 'setup'):
+        # A worker that wasn't forked starts without Django set up.
+        django.setup()
 
-            pks = []
+    _worker_command = Command()
+    _worker_command.setup_worker(options)
 
-            for obj_identifier in obj_identifiers:
-                current_index.remove_object(obj_identifier, using=self.using)
-                pks.append(self.split_obj_identifier(obj_identifier)[1])
-                self.processed_deletes.add(obj_identifier)
 
-            self.log.debug("Deleted objects for '%s': %s" % (object_path, ", ".join(pks)))
+def run_process_task(task):
+    return _worker_command.run_task(task)
@@ -0,0 +1,123 @@
+import datetime
+import json
+from optparse import make_option
+from queues import queues, QueueException
+from django.core.management.base import NoArgsCommand
+from django.utils import six
+from queued_search.messages import build_messages
+from queued_search.utils import get_dead_letter_queue_name, get_queue_name_for, write_messages
+
+
+class Command(NoArgsCommand):
+    help = "Inspect or replay the messages that have been dead lettered by process_search_queue."
+    can_import_settings = True
+    base_options = (
+        make_option('--replay', action='store_true', dest='replay',
+            default=False,
+            help='Put the dead letters back on the search queue, with their attempts reset.'
+        ),
+        make_option('-l', '--limit', action='store', dest='limit',
+            default=None, type='int',
+            help='Only look at this many dead letters.'
+        ),
+    )
+    option_list = NoArgsCommand.option_list + base_options
+
+    def handle_noargs(self, **options):
+        limit = options.get('limit')
+        dead_letter_queue = queues.Queue(get_dead_letter_queue_name())
+        raw_messages = []
+        replayed = set()
+
+        # Reading is destructive, so everything that hasn't been replayed
+        # gets written back once we're done, come what may.
+        try:
+            try:
+                while limit is None or len(raw_messages) < limit:
+                    message = dead_letter_queue.read()
+
+                    if not message:
+                        break
+
+                    raw_messages.append(message)
+            except QueueException:
+                # We've run out of dead letters.
+                pass
+
+            dead_letters = []
+
+            for offset, message in enumerate(raw_messages):
+                dead_letter = self.parse_dead_letter(message)
+
+                if dead_letter is None:
+                    self.stderr.write("Unable to parse dead letter '%s'.\n" % message)
+                    continue
+
+                dead_letters.append((offset, dead_letter))
+
+            if options.get('replay'):
+                self.replay(dead_letters, replayed)
+                self.stdout.write("Replayed %d dead letters.\n" % len(replayed))
+                return
+
+            for offset, dead_letter in dead_letters:
+                first_seen = dead_letter.get('first_seen')
+
+                if first_seen is not None:
+                    first_seen = datetime.datetime.fromtimestamp(first_seen).isoformat()
+
+                self.stdout.write("%s:%s - %s attempts, first seen %s: %s\n" % (
+                    dead_letter['action'],
+                    dead_letter['identifier'],
+                    dead_letter.get('attempts'),
+                    first_seen,
+                    dead_letter.get('error'),
+                ))
+
+            self.stdout.write("%d dead letters.\n" % len(raw_messages))
+        finally:
+            write_messages(dead_letter_queue, [message for offset, message in enumerate(raw_messages) if offset not in replayed])
+
+    def parse_dead_letter(self, message):
+        """
+        Parses a dead letter, as written by ``process_search_queue``.
+
+        Returns ``None`` for anything that isn't one, so it can be left on the
+        dead letter queue rather than failing the whole command.
+        """
+        try:
+            dead_letter = json.loads(message)
+        except ValueError:
+            return None
+
+        if not isinstance(dead_letter, dict):
+            return None
+
+        if dead_letter.get('action') not in ('update', 'delete'):
+            return None
+
+        if not isinstance(dead_letter.get('identifier'), six.string_types):
+            return None
+
+        if not isinstance(dead_letter.get('first_seen', 0), (six.integer_types, float, type(None))):
+            return None
+
+        return dead_letter
+
+    def replay(self, dead_letters, replayed):
+        """
+        Puts dead letters back on the queue (route/partition) each came from.
+
+        The offsets of those written are added to ``replayed``, so that if
+        one queue can't be written to, only what's left goes back on the dead
+        letter queue.
+        """
+        by_queue = {}
+
+        for offset, dead_letter in dead_letters:
+            queue_name = get_queue_name_for(dead_letter['identifier'])
+            by_queue.setdefault(queue_name, []).append((offset, dead_letter))
+
+        for queue_name, entries in by_queue.items():
+            write_messages(queues.Queue(queue_name), build_messages([(dead_letter['action'], dead_letter['identifier'], 0, None) for offset, dead_letter in entries]))
+            replayed.update([offset for offset, dead_letter in entries])
@@ -0,0 +1,195 @@
+import base64
+import json
+import re
+import zlib
+from django.conf import settings
+
+
+# Packed messages start with this...
+PACKED_PREFIX = '@'
+# ...or this, if they've been compressed as well.
+COMPRESSED_PREFIX = '@z'
+# Packed messages longer than this get compressed (if it helps).
+COMPRESS_THRESHOLD = 1024
+# Only pks like this are packed. Anything else could hold the characters
+# packed messages are split on, so it's sent as a plain message instead.
+PACKABLE_PK = re.compile(r'^[0-9]+$')
+
+
+def get_pack_size():
+    """
+    The most identifiers to pack into a single message.
+
+    Can be overridden by specifying ``SEARCH_QUEUE_PACK_SIZE`` in your
+    settings.
+    """
+    return getattr(settings, 'SEARCH_QUEUE_PACK_SIZE', 500)
+
+
+def should_pack_messages():
+    """
+    Whether to pack many identifiers into each message where we can.
+
+    Off unless ``SEARCH_QUEUE_PACK_MESSAGES`` is set in your settings. Only
+    turn it on once every ``process_search_queue`` understands packed
+    messages.
+    """
+    return getattr(settings, 'SEARCH_QUEUE_PACK_MESSAGES', False)
+
+
+def make_message(action, obj_identifier, attempts=0, first_seen=None):
+    """
+    Builds a message for the queue.
+
+    A message that's never failed is the plain, standardized string, like
+    ``update:notes.note.23``. One that has failed before is wrapped in a JSON
+    envelope, carrying how many times it's been attempted & when it was
+    first seen, like::
+
+        {"action": "update", "identifier": "notes.note.23", "attempts": 2, "first_seen": 1381234567.8}
+    """
+    if not attempts:
+        return "%s:%s" % (action, obj_identifier)
+
+    return json.dumps({
+        'action': action,
+        'identifier': obj_identifier,
+        'attempts': attempts,
+        'first_seen': first_seen,
+    })
+
+
+def pack_messages(pairs, size=None):
+    """
+    Packs ``(action, identifier)`` pairs into as few messages as possible.
+
+    They're coalesced by identifier first, with the last action winning
+    (cascades are coalesced separately, as they don't cancel out updates or
+    deletes). Identifiers are then grouped by action & model path, with the pks for
+    each group listed once, like::
+
+        @update/notes.note/23,24,25;delete/weblog.entry/8
+
+    Only integer pks are packed. Others are sent as plain messages, since
+    they could hold the ``/``, ``,`` & ``;`` packed messages are split on.
+    Long ones are compressed as well (see ``COMPRESSED_PREFIX``). No more
+    than ``size`` identifiers go in a single message.
+    """
+    size = size or get_pack_size()
+    latest = {}
+    ordered = []
+
+    for action, obj_identifier in pairs:
+        key = (action == 'cascade', obj_identifier)
+
+        if not key in latest:
+            ordered.append(key)
+
+        latest[key] = action
+
+    messages = []
+
+    for start in range(0, len(ordered), size):
+        groups = {}
+
+        for key in ordered[start:start + size]:
+            action = latest[key]
+            obj_identifier = key[1]
+
+            object_path, dot, pk = obj_identifier.rpartition('.')
+
+            if not dot or not PACKABLE_PK.match(pk):
+                # Nothing to group it by, or it can't be packed safely. Send
+                # it as-is.
+                messages.append(make_message(action, obj_identifier))
+                continue
+
+            groups.setdefault((action, object_path), []).append(pk)
+
+        if groups:
+            messages.append(encode_packed(groups))
+
+    return messages
+
+
+def build_messages(entries):
+    """
+    Builds the messages for many ``(action, identifier, attempts,
+    first_seen)`` entries at once.
+
+    Anything that's never failed is packed, if ``SEARCH_QUEUE_PACK_MESSAGES``
+    is on. Anything that has keeps its own envelope.
+    """
+    messages = []
+    fresh = []
+
+    for action, obj_identifier, attempts, first_seen in entries:
+        if attempts:
+            messages.append(make_message(action, obj_identifier, attempts, first_seen))
+        else:
+            fresh.append((action, obj_identifier))
+
+    if should_pack_messages():
+        messages.extend(pack_messages(fresh))
+    else:
+        messages.extend([make_message(action, obj_identifier) for action, obj_identifier in fresh])
+
+    return messages
+
+
+def encode_packed(groups):
+    body = ';'.join(['%s/%s/%s' % (action, object_path, ','.join(pks)) for (action, object_path), pks in sorted(groups.items())])
+
+    if len(body) > COMPRESS_THRESHOLD:
+        compressed = COMPRESSED_PREFIX + base64.b64encode(zlib.compress(body.encode('utf-8'))).decode('ascii')
+
+        if len(compressed) < len(body):
+            return compressed
+
+    return PACKED_PREFIX + body
+
+
+def decode_packed(message):
+    try:
+        if message.startswith(COMPRESSED_PREFIX):
+            body = zlib.decompress(base64.b64decode(message[len(COMPRESSED_PREFIX):].encode('ascii'))).decode('utf-8')
+        else:
+            body = message[len(PACKED_PREFIX):]
+
+        entries = []
+
+        for group in body.split(';'):
+            action, object_path, pks = group.split('/')
+
+            for pk in pks.split(','):
+                entries.append((action, '%s.%s' % (object_path, pk), 0, None))
+
+        return entries
+    except (ValueError, TypeError, zlib.error):
+        raise ValueError("Unable to parse message '%s'." % message)
+
+
+def parse_message(message):
+    """
+    Breaks down a message into a list of its action, identifier, attempts &
+    when it was first seen (``None`` if it's never failed).
+
+    Understands the plain string, the JSON envelope & packed messages, so
+    all three can be in the queue at once. Raises ``ValueError`` if it's none
+    of them.
+    """
+    if message.startswith(PACKED_PREFIX):
+        return decode_packed(message)
+
+    if message.startswith('{'):
+        try:
+            envelope = json.loads(message)
+            return [(envelope['action'], envelope['identifier'], envelope.get('attempts', 0), envelope.get('first_seen'))]
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError("Unable to parse message '%s'." % message)
+
+    if not ':' in message:
+        raise ValueError("Unable to parse message '%s'." % message)
+
+    action, obj_identifier = message.split(':', 1)
+    return [(action, obj_identifier, 0, None)]
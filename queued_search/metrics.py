@@ -0,0 +1,198 @@
+import os
+import socket
+import threading
+import time
+from django.conf import settings
+
+try:
+    from importlib import import_module
+except ImportError:
+    from django.utils.importlib import import_module
+
+
+def get_metrics():
+    """
+    Standardized way to fetch what ``process_search_queue`` records metrics
+    with.
+
+    Specify the class with ``SEARCH_QUEUE_METRICS`` in your settings (like
+    ``'queued_search.metrics.StatsdMetrics'``) & any arguments for it with
+    ``SEARCH_QUEUE_METRICS_OPTIONS``. Defaults to ``NullMetrics``, which
+    records nothing.
+    """
+    path = getattr(settings, 'SEARCH_QUEUE_METRICS', None)
+
+    if not path:
+        return NullMetrics()
+
+    module_path, class_name = path.rsplit('.', 1)
+    metrics_class = getattr(import_module(module_path), class_name)
+    return metrics_class(**getattr(settings, 'SEARCH_QUEUE_METRICS_OPTIONS', {}))
+
+
+class Timer(object):
+    """Records how long the ``with`` block it's used in takes."""
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.timing(self.name, time.time() - self.started, **self.labels)
+
+
+class Metrics(object):
+    """
+    Records counters, gauges & timings from processing the queue.
+
+    This one throws everything away. Subclasses override ``incr``, ``gauge``
+    & ``timing`` (& ``flush``, if they send things in bulk). Labels (like
+    ``model='notes.note'``) break a metric down further.
+    """
+    # Whether to bother with metrics that cost something to measure, like
+    # the depth of the queue.
+    enabled = True
+
+    def incr(self, name, value=1, **labels):
+        pass
+
+    def gauge(self, name, value, **labels):
+        pass
+
+    def timing(self, name, seconds, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def flush(self):
+        """Called after each window is processed & when the command exits."""
+        pass
+
+
+class NullMetrics(Metrics):
+    """Records nothing & skips measuring anything costly. The default."""
+    enabled = False
+
+
+class StatsdMetrics(Metrics):
+    """
+    Sends metrics to statsd over UDP, as they happen.
+
+    Labels are tacked on to the end of the name, like
+    ``queued_search.indexed.notes_note``.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='queued_search'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def incr(self, name, value=1, **labels):
+        self.send(name, labels, '%d|c' % value)
+
+    def gauge(self, name, value, **labels):
+        self.send(name, labels, '%s|g' % value)
+
+    def timing(self, name, seconds, **labels):
+        self.send(name, labels, '%d|ms' % (seconds * 1000))
+
+    def send(self, name, labels, value):
+        bits = [self.prefix, name]
+
+        for key in sorted(labels):
+            bits.append(str(labels[key]).replace('.', '_'))
+
+        try:
+            self.socket.sendto(('%s:%s' % ('.'.join(bits), value)).encode('utf-8'), self.address)
+        except socket.error:
+            # Metrics should never take the processing down with them.
+            pass
+
+
+class PrometheusTextfileMetrics(Metrics):
+    """
+    Writes metrics to a file for the Prometheus node exporter's textfile
+    collector, each time they're flushed.
+
+    Counters are ``<name>_total``, timings are summaries (``<name>_seconds``)
+    & everything's prefixed. With ``process`` workers, only what's recorded
+    in the command itself makes it into the file.
+    """
+    def __init__(self, path, prefix='queued_search'):
+        self.path = path
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def incr(self, name, value=1, **labels):
+        key = self.key(name, labels)
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def timing(self, name, seconds, **labels):
+        key = self.key(name, labels)
+
+        with self.lock:
+            count, total = self.timings.get(key, (0, 0.0))
+            self.timings[key] = (count + 1, total + seconds)
+
+    def format_line(self, name, labels, value):
+        if not labels:
+            return '%s %s' % (name, value)
+
+        label_bits = ['%s="%s"' % (label, str(label_value).replace('\\', '\\\\').replace('"', '\\"')) for label, label_value in labels]
+        return '%s{%s} %s' % (name, ','.join(label_bits), value)
+
+    def render(self):
+        lines = []
+
+        with self.lock:
+            for metrics, suffix, kind in ((self.counters, '_total', 'counter'), (self.gauges, '', 'gauge')):
+                seen = set()
+
+                for (name, labels), value in sorted(metrics.items()):
+                    full_name = '%s_%s%s' % (self.prefix, name, suffix)
+
+                    if not full_name in seen:
+                        lines.append('# TYPE %s %s' % (full_name, kind))
+                        seen.add(full_name)
+
+                    lines.append(self.format_line(full_name, labels, value))
+
+            seen = set()
+
+            for (name, labels), (count, total) in sorted(self.timings.items()):
+                full_name = '%s_%s_seconds' % (self.prefix, name)
+
+                if not full_name in seen:
+                    lines.append('# TYPE %s summary' % full_name)
+                    seen.add(full_name)
+
+                lines.append(self.format_line('%s_count' % full_name, labels, count))
+                lines.append(self.format_line('%s_sum' % full_name, labels, total))
+
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        # Written to the side & moved into place, so the collector never
+        # sees half a file.
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+
+        with open(temp_path, 'w') as temp_file:
+            temp_file.write(self.render())
+
+        os.rename(temp_path, self.path)
@@ -1,11 +1,84 @@
+import threading
 from queues import queues
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from haystack.exceptions import NotHandled
+from haystack.indexes import SearchIndex
 from haystack.signals import BaseSignalProcessor
 from haystack.utils import get_identifier
-from queued_search.utils import get_queue_name
+from queued_search.messages import build_messages
+from queued_search.spool import get_spool
+from queued_search.utils import get_catch_up_models, get_dependents, get_object_path, get_queue_name, get_queue_name_for, write_messages
+
+
+def get_field_names(model):
+    """A model's fields, by both name & attname (``update_fields`` can hold either)."""
+    model_fields = {}
+
+    for field in model._meta.fields:
+        model_fields[field.name] = field
+        model_fields[field.attname] = field
+
+    return model_fields
+
+
+def get_index_attrs(index, model, path=None):
+    """
+    The names of the model fields an index's documents are built from.
+
+    With ``path`` (one of the index's ``dependency_paths``), it's the fields
+    of the related model it leads to, like ``name`` for ``author__name``.
+
+    Returns ``None`` if we can't tell, because the index uses templates,
+    ``prepare`` methods or attributes that aren't model fields.
+    """
+    if type(index).prepare != SearchIndex.prepare or type(index).full_prepare != SearchIndex.full_prepare:
+        return None
+
+    model_fields = get_field_names(model)
+    attrs = set()
+
+    for field_name, field in index.fields.items():
+        if field.use_template or hasattr(index, 'prepare_%s' % field_name):
+            return None
+
+        if field.model_attr is None:
+            # Doesn't come from the object at all.
+            continue
+
+        model_attr = field.model_attr
+
+        if path is not None:
+            if model_attr == path:
+                # The related object itself, so anything could matter.
+                return None
+
+            if not model_attr.startswith(path + '__'):
+                # Doesn't come from the related object.
+                continue
+
+            model_attr = model_attr[len(path) + 2:]
+
+        attr = model_attr.split('__')[0]
+
+        if not attr in model_fields:
+            return None
+
+        attrs.add(model_fields[attr].name)
+        attrs.add(model_fields[attr].attname)
+
+    return attrs
 
 
 class QueuedSignalProcessor(BaseSignalProcessor):
+    def __init__(self, *args, **kwargs):
+        self.local = threading.local()
+        # The indexes for each model (& the fields they're built from).
+        self.model_indexes = {}
+        # The indexes depending on each model (see ``get_dependent_indexes``).
+        self.model_dependents = {}
+        super(QueuedSignalProcessor, self).__init__(*args, **kwargs)
+
     def setup(self):
         models.signals.post_save.connect(self.enqueue_save)
         models.signals.post_delete.connect(self.enqueue_delete)
@@ -15,11 +88,131 @@ class QueuedSignalProcessor(BaseSignalProcessor):
         models.signals.post_delete.disconnect(self.enqueue_delete)
 
     def enqueue_save(self, sender, instance, **kwargs):
+        if self.should_enqueue_cascade(sender, instance, **kwargs):
+            self.enqueue('cascade', instance)
+
+        if not self.should_enqueue_save(sender, instance, **kwargs):
+            return
+
         return self.enqueue('update', instance)
 
     def enqueue_delete(self, sender, instance, **kwargs):
+        if not self.get_indexes(sender):
+            return
+
         return self.enqueue('delete', instance)
 
+    def get_indexes(self, model):
+        """
+        Fetch the indexes for a model on any connection, along with the
+        fields each is built from (see ``get_index_attrs``).
+
+        Cached, so models without an index are cheap to skip.
+        """
+        if not model in self.model_indexes:
+            indexes = []
+
+            for using in self.connections.connections_info:
+                try:
+                    index = self.connections[using].get_unified_index().get_index(model)
+                except NotHandled:
+                    continue
+
+                indexes.append((index, get_index_attrs(index, model)))
+
+            self.model_indexes[model] = indexes
+
+        return self.model_indexes[model]
+
+    def get_dependent_indexes(self, model):
+        """
+        Fetch the indexes on any connection that depend on a model (by their
+        ``dependency_paths``), along with the path to it & the fields of it
+        each is built from (see ``get_index_attrs``).
+
+        Cached like ``get_indexes``, as it's checked on every save.
+        """
+        if not model in self.model_dependents:
+            dependents = []
+
+            for using in self.connections.connections_info:
+                for index, path in get_dependents(self.connections[using].get_unified_index()).get(model, []):
+                    dependents.append((index, path, get_index_attrs(index, model, path)))
+
+            self.model_dependents[model] = dependents
+
+        return self.model_dependents[model]
+
+    def get_update_fields(self, **kwargs):
+        """
+        The fields a save was limited to, if ``SEARCH_QUEUE_CHECK_UPDATE_FIELDS``
+        is on. Otherwise (or if it wasn't), ``None``.
+        """
+        if not getattr(settings, 'SEARCH_QUEUE_CHECK_UPDATE_FIELDS', False):
+            return None
+
+        return kwargs.get('update_fields')
+
+    def should_enqueue_cascade(self, sender, instance, **kwargs):
+        """
+        Whether a save should cascade to the objects depending on it.
+
+        Only models some index depends on do. With
+        ``SEARCH_QUEUE_CHECK_UPDATE_FIELDS`` on, saves whose ``update_fields``
+        don't include any field those indexes are built from don't either.
+        """
+        update_fields = self.get_update_fields(**kwargs)
+
+        for index, path, attrs in self.get_dependent_indexes(sender):
+            if update_fields is not None and attrs is not None and not attrs.intersection(update_fields):
+                continue
+
+            return True
+
+        return False
+
+    def should_enqueue_save(self, sender, instance, **kwargs):
+        """
+        Whether a save could change the search index at all.
+
+        Models without an index are skipped, as are saves every index's
+        ``should_update`` turns down & models that are caught up instead (see
+        ``is_caught_up``). With ``SEARCH_QUEUE_CHECK_UPDATE_FIELDS``
+        on, so are saves whose ``update_fields`` don't include any field the
+        index is built from.
+        """
+        if self.is_caught_up(sender):
+            return False
+
+        update_fields = self.get_update_fields(**kwargs)
+
+        for index, attrs in self.get_indexes(sender):
+            if not index.should_update(instance, **kwargs):
+                continue
+
+            if update_fields is not None and attrs is not None and not attrs.intersection(update_fields):
+                continue
+
+            return True
+
+        return False
+
+    def is_caught_up(self, model):
+        """
+        Whether saves of a model are left for ``process_search_queue
+        --catch-up`` to find by their updated field, rather than queued.
+
+        Only models in ``SEARCH_QUEUE_CATCH_UP_MODELS`` whose indexes all have
+        an updated field are. Deletes are always queued.
+        """
+        catch_up_models = get_catch_up_models()
+
+        if not catch_up_models or not get_object_path(model) in catch_up_models:
+            return False
+
+        indexes = self.get_indexes(model)
+        return bool(indexes) and all([index.get_updated_field() for index, attrs in indexes])
+
     def enqueue(self, action, instance):
         """
         Shoves a message about how to update the index into the queue.
@@ -29,7 +222,143 @@ class QueuedSignalProcessor(BaseSignalProcessor):
             ``update:notes.note.23``
             # ...or...
             ``delete:weblog.entry.8``
+            # ...or, for an object other indexes depend on...
+            ``cascade:notes.author.4``
+
+        Inside a transaction (on Django 1.9+, which has
+        ``transaction.on_commit``), the message is buffered instead & only
+        written once the transaction commits. See ``buffer``. On older
+        versions, it's written straight away.
+
+        If the object's model is routed elsewhere (``SEARCH_QUEUE_ROUTES``)
+        or the queue is partitioned (``SEARCH_QUEUE_PARTITIONS``), it goes to
+        the object's queue instead. With ``SEARCH_QUEUE_SPOOL_PATH`` set, it's
+        spooled locally & forwarded to the queue in the background.
+        """
+        obj_identifier = get_identifier(instance)
+        using = instance._state.db
+
+        if self.in_transaction(using):
+            return self.buffer(using, action, obj_identifier)
+
+        queue_name = get_queue_name_for(obj_identifier)
+        message = "%s:%s" % (action, obj_identifier)
+        spool = get_spool()
+
+        if spool is not None:
+            return spool.write(queue_name, [message])
+
+        return self.get_queue(queue_name).write(message)
+
+    def get_queue(self, queue_name=None):
+        """
+        Fetch this thread's connection to the queue (or another, by name),
+        opening it if needed.
+        """
+        if queue_name is None:
+            queue_name = get_queue_name()
+
+        if not hasattr(self.local, 'queues'):
+            self.local.queues = {}
+
+        if not queue_name in self.local.queues:
+            self.local.queues[queue_name] = queues.Queue(queue_name)
+
+        return self.local.queues[queue_name]
+
+    def close_queues(self):
+        """
+        Let go of this thread's connections to the queues, so they're opened
+        afresh next time.
+
+        Needed after deleting a queue on backends that hold the queue itself
+        (like the dummy backend), rather than a connection to it.
         """
-        message = "%s:%s" % (action, get_identifier(instance))
-        queue = queues.Queue(get_queue_name())
-        return queue.write(message)
+        self.local.queues = {}
+
+    def in_transaction(self, using):
+        """
+        Whether messages for the database should wait for it to commit.
+
+        Outside of a transaction, ``on_commit`` would run immediately anyway,
+        so there's no point buffering.
+        """
+        if not hasattr(transaction, 'on_commit'):
+            return False
+
+        return transaction.get_connection(using).in_atomic_block
+
+    def buffer(self, using, action, obj_identifier):
+        """
+        Holds a message until the current transaction commits.
+
+        Messages are coalesced by identifier, with the last action winning
+        (the same way ``process_search_queue`` treats them), so saving the same
+        object ten times only queues it once. If the transaction rolls back,
+        Django drops the callback & the buffered messages never get written.
+
+        Each savepoint's messages are buffered (& registered with
+        ``on_commit``) apart from those around it, so rolling back a
+        savepoint drops just its own. The buffers are written in the order
+        they were started, so the last action still wins.
+        """
+        if not hasattr(self.local, 'buffers'):
+            self.local.buffers = {}
+
+        savepoints = list(transaction.get_connection(using).savepoint_ids)
+        pending, flush, buffered_in = self.local.buffers.get(using, (None, None, None))
+
+        if pending is None or buffered_in != savepoints or not self.is_registered(using, flush):
+            # Either nothing is buffered yet, a savepoint's been entered or
+            # left since, or the transaction it was for rolled back. Start
+            # afresh.
+            pending = {}
+            flush = self.make_flush(using, pending)
+            self.local.buffers[using] = (pending, flush, savepoints)
+            transaction.on_commit(flush, using=using)
+
+        if action == 'cascade':
+            # Kept apart, as it doesn't cancel out an update or delete.
+            pending[('cascade', obj_identifier)] = action
+        else:
+            pending[obj_identifier] = action
+
+    def make_flush(self, using, pending):
+        def flush():
+            if self.local.buffers.get(using, (None, None, None))[0] is pending:
+                del self.local.buffers[using]
+
+            self.flush(pending)
+
+        return flush
+
+    def is_registered(self, using, flush):
+        """Whether a flush is still waiting on the transaction to commit."""
+        for hook in transaction.get_connection(using).run_on_commit:
+            if hook[1] is flush:
+                return True
+
+        return False
+
+    def flush(self, pending):
+        """
+        Writes the buffered messages to their queues in bulk.
+
+        With ``SEARCH_QUEUE_PACK_MESSAGES`` on, they're packed into as few
+        messages as possible (see ``messages.pack_messages``).
+        """
+        by_queue = {}
+
+        for obj_identifier, action in pending.items():
+            if action == 'cascade':
+                obj_identifier = obj_identifier[1]
+
+            by_queue.setdefault(get_queue_name_for(obj_identifier), []).append((action, obj_identifier, 0, None))
+
+        spool = get_spool()
+
+        for queue_name, entries in by_queue.items():
+            if spool is not None:
+                spool.write(queue_name, build_messages(entries))
+            else:
+                write_messages(self.get_queue(queue_name), build_messages(entries))
@@ -0,0 +1,377 @@
+import atexit
+import errno
+import logging
+import os
+import threading
+import time
+from queues import queues
+from django.conf import settings
+from queued_search.messages import build_messages, parse_message, should_pack_messages
+from queued_search.utils import write_messages
+
+
+# Spools are named like ``spool-1234.log``, by the process that owns them.
+SPOOL_PREFIX = 'spool-'
+SPOOL_SUFFIX = '.log'
+# How often to look for spools left behind by processes that have died.
+ADOPT_INTERVAL = 60
+# The longest to wait between attempts while the queue is down.
+MAX_BACKOFF = 30
+
+
+def get_spool_path():
+    """
+    Standardized way to fetch the directory messages are spooled to before
+    being sent to the queue.
+
+    Specified with ``SEARCH_QUEUE_SPOOL_PATH`` in your settings. Defaults to
+    ``None``, which writes straight to the queue.
+    """
+    return getattr(settings, 'SEARCH_QUEUE_SPOOL_PATH', None)
+
+
+def get_spool_interval():
+    """
+    How many seconds the forwarder waits between sending what's been spooled.
+
+    Can be overridden by specifying ``SEARCH_QUEUE_SPOOL_INTERVAL`` in your
+    settings.
+    """
+    return getattr(settings, 'SEARCH_QUEUE_SPOOL_INTERVAL', 0.5)
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def get_spool():
+    """
+    This process's spool, started on first use.
+
+    Returns ``None`` if spooling's off.
+    """
+    global _spool
+    path = get_spool_path()
+
+    if not path:
+        return None
+
+    with _spool_lock:
+        if _spool is None or _spool.pid != os.getpid() or _spool.path != path:
+            # Either it's the first message or we've been forked since, &
+            # the forwarder didn't come with us.
+            if _spool is not None:
+                _spool.stop()
+
+            _spool = Spool(path, get_spool_interval())
+            _spool.start()
+
+    return _spool
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # It's there, it just isn't ours.
+        return e.errno == errno.EPERM
+
+    return True
+
+
+def read_offset(spool_path):
+    """How far into a spool has already been sent."""
+    try:
+        with open(spool_path + '.offset') as offset_file:
+            return int(offset_file.read())
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def save_offset(spool_path, offset):
+    # Written to the side & moved into place, so it's never half written.
+    temp_path = spool_path + '.offset.tmp'
+
+    with open(temp_path, 'w') as offset_file:
+        offset_file.write(str(offset))
+
+    os.rename(temp_path, spool_path + '.offset')
+
+
+def read_spooled(spool_path, offset, limit):
+    """
+    Reads up to ``limit`` ``(queue name, message)`` entries from a spool,
+    starting at ``offset``.
+
+    Only complete entries are read, so one still being written (or cut short
+    by a crash) is left alone. Returns the entries & the offset after them.
+    """
+    entries = []
+
+    with open(spool_path, 'rb') as spool_file:
+        if offset > os.fstat(spool_file.fileno()).st_size:
+            # It was emptied after the offset was last saved.
+            offset = 0
+
+        spool_file.seek(offset)
+
+        for line in spool_file:
+            if len(entries) >= limit or not line.endswith(b'\n'):
+                break
+
+            offset += len(line)
+
+            try:
+                queue_name, message = line.decode('utf-8').rstrip(u'\n').split(u'\t', 1)
+            except ValueError:
+                logging.getLogger('queued_search').error("Skipping unreadable spooled message %r.", line)
+                continue
+
+            entries.append((queue_name, message))
+
+    return entries, offset
+
+
+class Spool(object):
+    """
+    A local, append-only file messages are written to instead of the queue,
+    so saving an object never waits on the queue backend (or fails because
+    it's down).
+
+    A background thread forwards what's been spooled to the queue in bulk
+    (packed, if ``SEARCH_QUEUE_PACK_MESSAGES`` is on), syncing the file to
+    disk as it goes. Each process has its own spool.
+    Anything a process didn't get to forward before it died is picked up by
+    the next process to start with the same spool directory.
+    """
+    def __init__(self, path, interval=0.5, batch_size=500):
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        self.spool_path = os.path.join(path, '%s%d%s' % (SPOOL_PREFIX, self.pid, SPOOL_SUFFIX))
+        self.fd = None
+        self.offset = 0
+        # Whether anything's been written since the file was last synced.
+        self.unsynced = False
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.queues = {}
+        self.log = logging.getLogger('queued_search')
+
+    def open(self):
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.fd = os.open(self.spool_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.offset = read_offset(self.spool_path)
+
+    def start(self):
+        """Open the spool & start forwarding from it in the background."""
+        self.open()
+        self.thread = threading.Thread(target=self.run, name='queued_search spool forwarder')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        """
+        Stop forwarding, sending anything that's left first if the queue's up.
+
+        Whatever can't be sent is picked up by the next process to start.
+        """
+        if self.fd is None or self.pid != os.getpid():
+            # Never opened, or it's another process's (we were forked).
+            return
+
+        self.stopping.set()
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+            if self.thread.is_alive():
+                # Stuck talking to the queue. Leave it for the next process.
+                return
+
+        try:
+            while self.forward() >= self.batch_size:
+                pass
+        except Exception as e:
+            self.log.error("Unable to forward spooled messages: %s. They'll be sent by the next process to start.", e)
+
+        os.close(self.fd)
+        self.fd = None
+
+    def write(self, queue_name, messages):
+        """Spools messages for a queue."""
+        data = u''.join([u'%s\t%s\n' % (queue_name, message) for message in messages]).encode('utf-8')
+
+        with self.lock:
+            while data:
+                data = data[os.write(self.fd, data):]
+
+            self.unsynced = True
+
+        return True
+
+    def run(self):
+        backoff = self.interval
+        adopted_at = 0
+
+        while True:
+            self.stopping.wait(backoff)
+
+            if self.stopping.is_set():
+                break
+
+            try:
+                if time.time() - adopted_at >= ADOPT_INTERVAL:
+                    self.adopt()
+                    adopted_at = time.time()
+
+                while self.forward() >= self.batch_size and not self.stopping.is_set():
+                    pass
+
+                backoff = self.interval
+            except Exception as e:
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                self.log.error("Unable to forward spooled messages: %s. Retrying in %s seconds.", e, backoff)
+
+    def forward(self):
+        """
+        Sends the next batch of what's been spooled to the queue.
+
+        Returns how many messages were sent.
+        """
+        with self.lock:
+            unsynced, self.unsynced = self.unsynced, False
+
+        if unsynced:
+            os.fsync(self.fd)
+
+        entries, offset = read_spooled(self.spool_path, self.offset, self.batch_size)
+
+        if entries:
+            self.send(entries)
+
+        if offset != self.offset:
+            self.offset = offset
+            save_offset(self.spool_path, offset)
+
+        with self.lock:
+            if self.offset and os.fstat(self.fd).st_size == self.offset:
+                # Everything's been sent, so start afresh rather than letting
+                # the file grow forever.
+                self.offset = 0
+                save_offset(self.spool_path, 0)
+                os.ftruncate(self.fd, 0)
+
+        return len(entries)
+
+    def adopt(self):
+        """
+        Sends whatever's left in the spools of processes that have died, then
+        removes them.
+
+        Each is renamed first, so only one process sends it.
+        """
+        for filename in sorted(os.listdir(self.path)):
+            if not filename.startswith(SPOOL_PREFIX) or not filename.endswith(SPOOL_SUFFIX):
+                continue
+
+            spool_path = os.path.join(self.path, filename)
+            name = filename[len(SPOOL_PREFIX):-len(SPOOL_SUFFIX)]
+
+            try:
+                owner = int(name.split('.')[0])
+            except ValueError:
+                continue
+
+            if spool_path == self.spool_path:
+                continue
+
+            if owner != self.pid:
+                if is_alive(owner):
+                    continue
+
+                # Claim it, as ``spool-<our pid>.<its pid>.log``.
+                claimed_path = os.path.join(self.path, '%s%d.%s%s' % (SPOOL_PREFIX, self.pid, name, SPOOL_SUFFIX))
+
+                try:
+                    os.rename(spool_path, claimed_path)
+                except OSError:
+                    # Someone else got there first.
+                    continue
+
+                if os.path.exists(spool_path + '.offset'):
+                    os.rename(spool_path + '.offset', claimed_path + '.offset')
+
+                spool_path = claimed_path
+
+            self.replay(spool_path)
+
+    def replay(self, spool_path):
+        offset = read_offset(spool_path)
+        sent = 0
+
+        while True:
+            entries, offset = read_spooled(spool_path, offset, self.batch_size)
+
+            if not entries:
+                break
+
+            self.send(entries)
+            save_offset(spool_path, offset)
+            sent += len(entries)
+
+        os.remove(spool_path)
+
+        if os.path.exists(spool_path + '.offset'):
+            os.remove(spool_path + '.offset')
+
+        self.log.info("Sent %d messages left in '%s'.", sent, spool_path)
+
+    def send(self, entries):
+        """Writes spooled entries to their queues, in bulk & in order."""
+        by_queue = {}
+        queue_names = []
+
+        for queue_name, message in entries:
+            if not queue_name in by_queue:
+                by_queue[queue_name] = []
+                queue_names.append(queue_name)
+
+            by_queue[queue_name].append(message)
+
+        for queue_name in queue_names:
+            if not queue_name in self.queues:
+                self.queues[queue_name] = queues.Queue(queue_name)
+
+            write_messages(self.queues[queue_name], self.pack(by_queue[queue_name]))
+
+    def pack(self, messages):
+        """
+        Packs a queue's spooled messages into as few as possible, if
+        ``SEARCH_QUEUE_PACK_MESSAGES`` is on (see ``build_messages``).
+
+        Each save is spooled as its own message, so this is where most of
+        them get packed.
+        """
+        if not should_pack_messages():
+            return messages
+
+        entries = []
+        unparseable = []
+
+        for message in messages:
+            try:
+                entries.extend(parse_message(message))
+            except ValueError:
+                # Not ours to fix. Pass it on as it is.
+                unparseable.append(message)
+
+        return build_messages(entries) + unparseable
@@ -1,13 +1,537 @@
+import re
+import threading
+import time
+import zlib
+from queues import QueueException
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
+try:
+    from queue import Empty, Full, Queue
+except ImportError:
+    from Queue import Empty, Full, Queue
 
-def get_queue_name():
+
+# Anything that isn't routed anywhere else goes to the plain queue.
+DEFAULT_ROUTE = 'default'
+# Plain ASCII digits, unlike ``isdigit``, which takes any Unicode digit.
+INTEGER_PK = re.compile(r'^[0-9]+$')
+
+
+def get_queue_name(partition=None, route=None):
     """
     Standized way to fetch the queue name.
 
     Can be overridden by specifying ``SEARCH_QUEUE_NAME`` in your settings.
+    Given a route (other than the default) or partition, it's the name of
+    that route's/partition's queue instead, with them on the end.
 
     Given that the queue name is used in disparate places, this is primarily
     for sanity.
     """
-    return getattr(settings, 'SEARCH_QUEUE_NAME', 'haystack_search_queue')
+    queue_name = getattr(settings, 'SEARCH_QUEUE_NAME', 'haystack_search_queue')
+
+    if route is not None and route != DEFAULT_ROUTE:
+        queue_name = '%s_%s' % (queue_name, route)
+
+    if partition is not None:
+        queue_name = '%s_%d' % (queue_name, partition)
+
+    return queue_name
+
+
+def get_queue_name_for(obj_identifier, partitions=None):
+    """
+    The name of the queue messages about an object go to, given its route &
+    partition.
+    """
+    return get_queue_name(get_partition(obj_identifier, partitions), get_route(obj_identifier))
+
+
+def get_queue_routes():
+    """
+    Standardized way to fetch how messages are routed to queues by model.
+
+    Specified with ``SEARCH_QUEUE_ROUTES`` in your settings, which maps a
+    name for each route to the models that go to it (labelled the same way
+    as in identifiers, like ``notes.note``), its priority & the share of each
+    window it's limited to while anything else is waiting, like::
+
+        SEARCH_QUEUE_ROUTES = {
+            'bulk': {'models': ['logs.entry'], 'priority': -1, 'share': 0.2},
+        }
+
+    Anything that isn't routed goes to the ``default`` route, which can be
+    given a priority & share the same way. Priorities default to 0 & shares
+    to no limit.
+    """
+    routes = {
+        DEFAULT_ROUTE: {'models': [], 'priority': 0, 'share': None},
+    }
+
+    for name, route in getattr(settings, 'SEARCH_QUEUE_ROUTES', {}).items():
+        routes[name] = {
+            'models': list(route.get('models', [])),
+            'priority': route.get('priority', 0),
+            'share': route.get('share'),
+        }
+
+    return routes
+
+
+def get_route(obj_identifier):
+    """
+    Which route messages about an object go to, by its model.
+    """
+    object_path = obj_identifier.rsplit('.', 1)[0]
+
+    for name, route in getattr(settings, 'SEARCH_QUEUE_ROUTES', {}).items():
+        if object_path in route.get('models', ()):
+            return name
+
+    return DEFAULT_ROUTE
+
+
+def get_queue_partitions():
+    """
+    Standardized way to fetch how many partitions the queue is split into.
+
+    Can be overridden by specifying ``SEARCH_QUEUE_PARTITIONS`` in your
+    settings. Defaults to 1, which leaves the queue unpartitioned.
+    """
+    return getattr(settings, 'SEARCH_QUEUE_PARTITIONS', 1)
+
+
+def get_partition(obj_identifier, partitions=None):
+    """
+    Which partition messages about an object go to.
+
+    Every message about the same object lands in the same partition, so
+    they're still processed in order. Returns ``None`` if the queue isn't
+    partitioned.
+    """
+    if partitions is None:
+        partitions = get_queue_partitions()
+
+    if partitions <= 1:
+        return None
+
+    # Unlike ``hash``, this is the same in every process & Python version.
+    return (zlib.crc32(obj_identifier.encode('utf-8')) & 0xffffffff) % partitions
+
+
+def get_catch_up_models():
+    """
+    Standardized way to fetch the models that are caught up by their updated
+    field, rather than queued on every save.
+
+    Specified with ``SEARCH_QUEUE_CATCH_UP_MODELS`` in your settings, as model
+    paths (like ``logs.entry``). Defaults to none.
+    """
+    return getattr(settings, 'SEARCH_QUEUE_CATCH_UP_MODELS', [])
+
+
+def get_catch_up_overlap():
+    """
+    How many seconds before the last change found to look again, when
+    catching up, for rows whose change was committed late.
+
+    Can be overridden by specifying ``SEARCH_QUEUE_CATCH_UP_OVERLAP`` in your
+    settings. Defaults to 5.
+    """
+    return getattr(settings, 'SEARCH_QUEUE_CATCH_UP_OVERLAP', 5)
+
+
+def get_object_path(model):
+    """
+    A model's path, the way it appears in identifiers (like ``notes.note``).
+    """
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+
+def get_related_model(model, path):
+    """
+    The model a lookup path (like ``author__publisher``) leads to from a
+    model, or ``None`` if it doesn't lead to one.
+    """
+    for name in path.split('__'):
+        opts = model._meta
+
+        if hasattr(opts, 'get_field_by_name'):
+            field, field_model, direct, m2m = opts.get_field_by_name(name)
+
+            if direct:
+                model = field.rel.to if field.rel else None
+            else:
+                # A reverse relation, to the model holding the key.
+                model = field.model
+        else:
+            model = opts.get_field(name).related_model
+
+        if model is None:
+            return None
+
+    return model
+
+
+# What ``get_dependents`` found for each unified index (by ``id``), along
+# with the ``indexes`` it was found from. Rebuilding a unified index replaces
+# its ``indexes``, so what was found for it is found again.
+_dependents = {}
+
+
+def get_dependents(unified_index):
+    """
+    Which indexes depend on which other models.
+
+    An index declares what it depends on with ``dependency_paths``, a list
+    of lookup paths from its model to others (like ``['author']``), for when
+    its documents include data from them. Returns the indexes & paths for
+    each model that's depended on, like ``{Author: [(NoteIndex(), 'author')]}``.
+
+    Worked out once per unified index (& again if it's rebuilt), as it's
+    checked on every save.
+    """
+    cached = _dependents.get(id(unified_index))
+
+    if cached is not None and cached[0] is unified_index.indexes:
+        return cached[1]
+
+    dependents = {}
+
+    for model in unified_index.get_indexed_models():
+        index = unified_index.get_index(model)
+
+        for path in getattr(index, 'dependency_paths', ()):
+            related_model = get_related_model(model, path)
+
+            if related_model is None:
+                raise ImproperlyConfigured("The dependency path '%s' on the index for %s doesn't lead to a related model." % (path, get_object_path(model)))
+
+            dependents.setdefault(related_model, []).append((index, path))
+
+    _dependents[id(unified_index)] = (unified_index.indexes, dependents)
+    return dependents
+
+
+def get_dead_letter_queue_name():
+    """
+    Standardized way to fetch the name of the queue failed messages go to.
+
+    Can be overridden by specifying ``SEARCH_DEAD_LETTER_QUEUE_NAME`` in your
+    settings. Defaults to the queue name, with ``_dead_letters`` on the end.
+    """
+    return getattr(settings, 'SEARCH_DEAD_LETTER_QUEUE_NAME', '%s_dead_letters' % get_queue_name())
+
+
+# How many messages to send to the queue in one request when bulk writing.
+BULK_WRITE_SIZE = 1000
+# SQS can't take more than this in a single batch.
+SQS_BATCH_SIZE = 10
+
+
+def write_messages(queue, messages):
+    """
+    Writes many messages to the queue at once.
+
+    Where the queue backend supports it, messages go out in bulk (a pipeline
+    for Redis, batched sends for SQS) rather than a round-trip per message.
+    Anything else gets the messages written one at a time.
+    """
+    messages = list(messages)
+    backend = getattr(queue, 'backend', None)
+
+    if backend == 'redis':
+        for start in range(0, len(messages), BULK_WRITE_SIZE):
+            pipeline = queue._connection.pipeline()
+
+            for message in messages[start:start + BULK_WRITE_SIZE]:
+                pipeline.rpush(queue.name, message)
+
+            pipeline.execute()
+    elif backend == 'sqs':
+        from boto.sqs.message import Message
+
+        for start in range(0, len(messages), SQS_BATCH_SIZE):
+            batch = []
+
+            for offset, message in enumerate(messages[start:start + SQS_BATCH_SIZE]):
+                # Encoded the same way a single ``write`` would be.
+                batch.append((str(offset), Message(body=message).get_body_encoded(), 0))
+
+            queue._queue.write_batch(batch)
+    else:
+        for message in messages:
+            queue.write(message)
+
+    return len(messages)
+
+
+class PrefetchingQueue(object):
+    """
+    Wraps a queue, reading ahead from it in a background thread.
+
+    Reading then overlaps with whatever's being done with the messages
+    already read (fetching from the database & sending to the backend)
+    rather than waiting on it. ``read`` returns ``None`` once the queue's
+    been found empty & everything read ahead has been handed out.
+    """
+    # How long to wait before checking an empty queue again.
+    poll_interval = 0.5
+
+    def __init__(self, queue, size):
+        self.queue = queue
+        self.name = getattr(queue, 'name', None)
+        self.buffer = Queue(size)
+        self.unbuffered = []
+        self.empty = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.read_ahead)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.queue) + self.buffer.qsize()
+
+    def read_ahead(self):
+        while not self.stopping.is_set():
+            # Only flagged as empty while we're not in the middle of a read.
+            self.empty.clear()
+
+            try:
+                message = self.queue.read()
+            except QueueException:
+                message = None
+
+            if not message:
+                self.empty.set()
+                self.stopping.wait(self.poll_interval)
+                continue
+
+            while True:
+                if self.stopping.is_set():
+                    # No room before we were stopped. It's written back with
+                    # the rest.
+                    self.unbuffered.append(message)
+                    break
+
+                try:
+                    self.buffer.put(message, timeout=self.poll_interval)
+                    break
+                except Full:
+                    pass
+
+    def read(self):
+        while True:
+            try:
+                return self.buffer.get(timeout=0.1)
+            except Empty:
+                if self.empty.is_set() and self.buffer.empty():
+                    return None
+
+    def buffered(self):
+        """The messages read ahead but not handed out yet."""
+        with self.buffer.mutex:
+            return list(self.buffer.queue) + list(self.unbuffered)
+
+    def close(self):
+        """
+        Stop reading ahead & write anything read but not handed out back to
+        the queue.
+
+        Returns how many messages were written back.
+        """
+        self.stopping.set()
+        self.thread.join()
+        messages = []
+
+        while True:
+            try:
+                messages.append(self.buffer.get_nowait())
+            except Empty:
+                break
+
+        messages.extend(self.unbuffered)
+        return write_messages(self.queue, messages)
+
+
+class RateLimiter(object):
+    """
+    Limits how many of something (documents, requests) happen per second.
+
+    A token bucket, holding up to a second's worth. Anything bigger than the
+    bucket still goes ahead once it's full, leaving the bucket in debt for
+    those after it. ``slow_down`` halves the rate, for when the backend's
+    struggling, & ``speed_up`` recovers it a little at a time.
+    """
+    def __init__(self, rate):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.capacity = max(self.max_rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Wait until ``amount`` more can go ahead."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                needed = min(amount, self.capacity)
+
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+
+                wait = (needed - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self.lock:
+            # Never all the way to a standstill.
+            self.rate = max(self.rate / 2, self.max_rate / 64)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.rate + self.max_rate / 10, self.max_rate)
+
+
+def split_identifier(obj_identifier):
+    """
+    Splits an identifier (like ``notes.note.23``) into its model path & pk,
+    the way ``IdentifierSet`` holds them.
+
+    The pk's an int where it is one. Identifiers without a model path come
+    back whole, with ``None`` for the model path.
+    """
+    if not '.' in obj_identifier:
+        return (None, obj_identifier)
+
+    object_path, pk = obj_identifier.rsplit('.', 1)
+
+    # Only if it comes back out the same, so ``07`` stays ``07``.
+    if INTEGER_PK.match(pk) and str(int(pk)) == pk:
+        pk = int(pk)
+
+    return (object_path, pk)
+
+
+class IdentifierSet(object):
+    """
+    A set of object identifiers (like ``notes.note.23``), stored compactly.
+
+    Rather than a string per identifier, each model path is held once, with
+    its pks in a set under it (as ints, where they are). For a big backlog of
+    a few models, that's a fraction of the memory. Otherwise, it behaves like
+    a set of the identifiers.
+
+    Splitting an identifier up is most of the cost of looking it up, so
+    anything taking an identifier also takes one already split by
+    ``split_identifier``. Split it once & use that for every lookup.
+    """
+    def __init__(self, obj_identifiers=()):
+        # The pks for each model path. Identifiers without a model path are
+        # kept whole, under ``None``.
+        self.models = {}
+        self.size = 0
+        self.update(obj_identifiers)
+
+    def split(self, obj_identifier):
+        if isinstance(obj_identifier, tuple):
+            return obj_identifier
+
+        return split_identifier(obj_identifier)
+
+    def join(self, object_path, pk):
+        if object_path is None:
+            return pk
+
+        return '%s.%s' % (object_path, pk)
+
+    def add(self, obj_identifier):
+        object_path, pk = self.split(obj_identifier)
+        pks = self.models.get(object_path)
+
+        if pks is None:
+            pks = self.models[object_path] = set()
+
+        if not pk in pks:
+            pks.add(pk)
+            self.size += 1
+
+    def update(self, obj_identifiers):
+        for obj_identifier in obj_identifiers:
+            self.add(obj_identifier)
+
+    def discard(self, obj_identifier):
+        object_path, pk = self.split(obj_identifier)
+        pks = self.models.get(object_path)
+
+        if pks is None or not pk in pks:
+            return
+
+        pks.remove(pk)
+        self.size -= 1
+
+        if not pks:
+            del self.models[object_path]
+
+    def remove(self, obj_identifier):
+        if not obj_identifier in self:
+            raise KeyError(obj_identifier)
+
+        self.discard(obj_identifier)
+
+    def clear(self):
+        self.models = {}
+        self.size = 0
+
+    def pks(self, object_path):
+        """The pks held for a model path."""
+        return self.models.get(object_path, set())
+
+    def object_paths(self):
+        """The model paths anything's held for, sorted."""
+        return sorted([object_path for object_path in self.models if object_path is not None])
+
+    def unparseable(self):
+        """Anything held that doesn't have a model path."""
+        return self.models.get(None, set())
+
+    def __contains__(self, obj_identifier):
+        object_path, pk = self.split(obj_identifier)
+        return pk in self.models.get(object_path, ())
+
+    def __iter__(self):
+        for object_path, pks in self.models.items():
+            for pk in pks:
+                yield self.join(object_path, pk)
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        if isinstance(other, IdentifierSet):
+            other = set(other)
+
+        if not isinstance(other, (set, frozenset)):
+            return NotImplemented
+
+        return set(self) == other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+
+        if result is NotImplemented:
+            return result
+
+        return not result
+
+    # Mutable, like a set.
+    __hash__ = None
+
+    def __repr__(self):
+        return 'IdentifierSet(%r)' % sorted(self)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+Benchmarks the hot paths of ``queued_search``, entirely offline (SQLite in
+memory, the dummy queue backend & Haystack's simple backend or Whoosh).
+
+Measures the overhead ``QueuedSignalProcessor`` adds to each save, plus how
+fast ``process_search_queue`` drains the queue (& its peak memory, where
+``tracemalloc`` is available) by queue size, batch size & number of models.
+Results are written as JSON, so runs can be compared.
+
+Usage::
+
+    python runbenchmarks.py [--quick] [--engine=simple|whoosh] [--output=results.json]
+"""
+import json
+import logging
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from django.conf import settings
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+ENGINES = {
+    'simple': 'haystack.backends.simple_backend.SimpleEngine',
+    'whoosh': 'haystack.backends.whoosh_backend.WhooshEngine',
+}
+SCENARIOS = {
+    'full': {
+        'saves': 2000,
+        'queue_sizes': [1000, 10000],
+        'batch_sizes': [100, 1000],
+        'model_counts': [1, 4],
+    },
+    'quick': {
+        'saves': 200,
+        'queue_sizes': [200],
+        'batch_sizes': [50],
+        'model_counts': [1, 2],
+    },
+}
+
+
+def configure(engine, index_path):
+    settings.configure(
+        DATABASES={
+            'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        },
+        INSTALLED_APPS=[
+            'haystack',
+            'queued_search',
+            'benchmarks',
+        ],
+        HAYSTACK_CONNECTIONS={
+            'default': {
+                'ENGINE': ENGINES[engine],
+                'PATH': index_path,
+            },
+        },
+        HAYSTACK_SIGNAL_PROCESSOR='queued_search.signals.QueuedSignalProcessor',
+        QUEUE_BACKEND='dummy',
+        SEARCH_QUEUE_LOG_LEVEL=logging.ERROR
+    )
+
+    # The simple backend warns about everything it doesn't do.
+    logging.getLogger('haystack').setLevel(logging.ERROR)
+
+    import django
+
+    if hasattr(django, 'setup'):
+        django.setup()
+
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+
+
+def create_documents(count, model_count):
+    """Create ``count`` documents, spread evenly across the models."""
+    from benchmarks.models import document_models
+
+    created = []
+
+    for model in document_models[:model_count]:
+        model.objects.all().delete()
+
+    for offset, model in enumerate(document_models[:model_count]):
+        model.objects.bulk_create([
+            model(title='Document #%d' % number, content='Benchmark data, number %d.' % number, author='Daniel')
+            for number in range(offset, count, model_count)
+        ])
+        created.extend(model.objects.all())
+
+    return created
+
+
+def reset_queue():
+    from queues import queues
+    from queued_search.utils import get_queue_name
+
+    queues.delete_queue(get_queue_name())
+    return queues.Queue(get_queue_name())
+
+
+def benchmark_enqueue(saves):
+    """
+    Time saving documents with & without the signal processor connected.
+
+    The difference is the overhead of queuing, per save.
+    """
+    from django.db import transaction
+    from haystack import signal_processor
+
+    documents = create_documents(min(saves, 100), 1)
+    results = []
+
+    def save_all():
+        started = time.time()
+
+        for number in range(saves):
+            documents[number % len(documents)].save()
+
+        return time.time() - started
+
+    reset_queue()
+    signal_processor.teardown()
+
+    try:
+        baseline = save_all()
+    finally:
+        signal_processor.setup()
+
+    variants = [('autocommit', save_all)]
+
+    if hasattr(transaction, 'atomic'):
+        def save_all_atomic():
+            with transaction.atomic():
+                return save_all()
+
+        variants.append(('transaction', save_all_atomic))
+
+    for mode, run in variants:
+        reset_queue()
+        seconds = run()
+        results.append({
+            'benchmark': 'enqueue',
+            'mode': mode,
+            'saves': saves,
+            'seconds': seconds,
+            'baseline_seconds': baseline,
+            'overhead_per_save_us': (seconds - baseline) / saves * 1000000,
+        })
+
+    return results
+
+
+def fill_queue(queue_size, model_count):
+    from queued_search.utils import write_messages
+
+    documents = create_documents(queue_size, model_count)
+    queue = reset_queue()
+    messages = ['update:%s.%s.%s' % (document._meta.app_label, document._meta.object_name.lower(), document.pk) for document in documents]
+    write_messages(queue, messages)
+    return queue
+
+
+def drain(batch_size):
+    from django.core.management import call_command
+
+    call_command('clear_index', interactive=False, verbosity=0)
+    started = time.time()
+    call_command('process_search_queue', batchsize=batch_size)
+    return time.time() - started
+
+
+def benchmark_drain(queue_size, batch_size, model_count):
+    """
+    Time draining a full queue, then drain it again to measure peak memory
+    (tracing slows it down, so it's done separately).
+    """
+    queue = fill_queue(queue_size, model_count)
+    seconds = drain(batch_size)
+
+    if len(queue):
+        raise RuntimeError("The queue wasn't drained.")
+
+    peak_memory = None
+
+    if tracemalloc is not None:
+        fill_queue(queue_size, model_count)
+        tracemalloc.start()
+
+        try:
+            drain(batch_size)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'benchmark': 'drain',
+        'queue_size': queue_size,
+        'batch_size': batch_size,
+        'models': model_count,
+        'seconds': seconds,
+        'per_second': queue_size / seconds if seconds else None,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def get_environment(engine):
+    import django
+    import haystack
+
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'haystack': '.'.join([str(bit) for bit in haystack.__version__]),
+        'engine': engine,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def runbenchmarks(*args):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--quick', action='store_true', dest='quick', default=False,
+        help='Run a small set of benchmarks, for a quick check.')
+    parser.add_option('--engine', action='store', dest='engine', default='simple', type='choice',
+        choices=sorted(ENGINES.keys()),
+        help='The Haystack backend to index into. "simple" (the default) discards documents, isolating our own overhead.')
+    parser.add_option('--output', action='store', dest='output', default=None,
+        help='Write the results to this file, rather than stdout.')
+    options, extra = parser.parse_args(list(args))
+    scenario = SCENARIOS['quick' if options.quick else 'full']
+    index_path = tempfile.mkdtemp()
+
+    try:
+        configure(options.engine, index_path)
+        results = benchmark_enqueue(scenario['saves'])
+
+        for queue_size in scenario['queue_sizes']:
+            for batch_size in scenario['batch_sizes']:
+                for model_count in scenario['model_counts']:
+                    results.append(benchmark_drain(queue_size, batch_size, model_count))
+                    sys.stderr.write("drain %(queue_size)d messages, batches of %(batch_size)d, %(models)d model(s): %(seconds).3fs\n" % results[-1])
+
+        output = json.dumps({
+            'environment': get_environment(options.engine),
+            'results': results,
+        }, indent=2, sort_keys=True)
+    finally:
+        shutil.rmtree(index_path, ignore_errors=True)
+
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    runbenchmarks(*sys.argv[1:])
@@ -19,7 +19,11 @@ settings.configure(
         'default': {
             'ENGINE': 'haystack.backends.whoosh_backend.WhooshEngine',
             'PATH': os.path.join(os.path.dirname(__file__), 'whoosh_index')
-        }
+        },
+        'shadow': {
+            'ENGINE': 'haystack.backends.whoosh_backend.WhooshEngine',
+            'PATH': os.path.join(os.path.dirname(__file__), 'whoosh_shadow_index')
+        },
     },
     HAYSTACK_SIGNAL_PROCESSOR='queued_search.signals.QueuedSignalProcessor',
     QUEUE_BACKEND='dummy',
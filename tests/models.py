@@ -11,3 +11,29 @@ class Note(models.Model):
     
     def __unicode__(self):
         return self.title
+
+
+# Not registered with any index.
+class Tag(models.Model):
+    name = models.CharField(max_length=64)
+
+    def __unicode__(self):
+        return self.name
+
+
+# Not indexed itself, but ``BookIndex`` depends on it.
+class Author(models.Model):
+    name = models.CharField(max_length=64)
+    # Not in any document.
+    email = models.CharField(max_length=128, blank=True)
+
+    def __unicode__(self):
+        return self.name
+
+
+class Book(models.Model):
+    title = models.CharField(max_length=128)
+    author = models.ForeignKey(Author)
+
+    def __unicode__(self):
+        return self.title
@@ -1,5 +1,5 @@
 from haystack import indexes
-from .models import Note
+from .models import Book, Note
 
 
 # Simplest possible subclass that could work.
@@ -8,3 +8,15 @@ class NoteIndex(indexes.SearchIndex, indexes.Indexable):
 
     def get_model(self):
         return Note
+
+
+# Documents include the author's name, so renaming an author needs to
+# reindex their books.
+class BookIndex(indexes.SearchIndex, indexes.Indexable):
+    text = indexes.CharField(document=True, model_attr='title')
+    author = indexes.CharField(model_attr='author__name')
+
+    dependency_paths = ['author']
+
+    def get_model(self):
+        return Book
@@ -1,12 +1,35 @@
+import datetime
+import json
 import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+try:
+    from unittest import skipUnless
+except ImportError:
+    # Python 2.6.
+    from django.utils.unittest import skipUnless
 from queues import queues, QueueException
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import transaction
 from django.test import TestCase
-from haystack import connections
+from django.utils.six import StringIO
+from haystack import connections, signal_processor
 from haystack.query import SearchQuerySet
+from haystack.utils import get_identifier
+from haystack.utils.loading import UnifiedIndex
 from queued_search.management.commands.process_search_queue import Command as ProcessSearchQueueCommand
-from queued_search.utils import get_queue_name
-from .models import Note
+from queued_search.messages import pack_messages, parse_message
+from queued_search.metrics import Metrics, PrometheusTextfileMetrics
+from queued_search.spool import Spool, get_spool
+from queued_search.backends import is_overload_error, is_transport_error, prepare_documents, update_objects
+from queued_search.utils import IdentifierSet, PrefetchingQueue, RateLimiter, get_dead_letter_queue_name, get_dependents, get_partition, get_queue_name, split_identifier
+from .models import Author, Book, Note, Tag
+from .search_indexes import BookIndex
 
 
 class AssertableHandler(logging.Handler):
@@ -16,6 +39,13 @@ class AssertableHandler(logging.Handler):
         AssertableHandler.stowed_messages.append(record.getMessage())
 
 
+class RecordingMetrics(Metrics):
+    recorded = []
+
+    def incr(self, name, value=1, **labels):
+        RecordingMetrics.recorded.append((name, value, labels))
+
+
 assertable = AssertableHandler()
 logging.getLogger('queued_search').addHandler(assertable)
 
@@ -24,8 +54,9 @@ class QueuedSearchIndexTestCase(TestCase):
     def setUp(self):
         super(QueuedSearchIndexTestCase, self).setUp()
 
-        # Nuke the queue.
+        # Nuke the queue (& the signal processor's hold on it).
         queues.delete_queue(get_queue_name())
+        signal_processor.close_queues()
 
         # Nuke the index.
         call_command('clear_index', interactive=False, verbosity=0)
@@ -96,6 +127,7 @@ class QueuedSearchIndexTestCase(TestCase):
 
         # Dump the queue in preparation for the deletes.
         queues.delete_queue(get_queue_name())
+        signal_processor.close_queues()
         self.queue = queues.Queue(get_queue_name())
 
         self.assertEqual(len(self.queue), 0)
@@ -118,6 +150,61 @@ class QueuedSearchIndexTestCase(TestCase):
 
         self.assertEqual(messages, [u'delete:tests.note.1', u'delete:tests.note.2', u'delete:tests.note.3'])
 
+    def test_skips_unindexed_models(self):
+        tag = Tag.objects.create(name='Nobody searches for me.')
+        self.assertEqual(len(self.queue), 0)
+
+        tag.delete()
+        self.assertEqual(len(self.queue), 0)
+
+    def test_should_update(self):
+        # Every connection's index has to turn it down for it to be skipped.
+        indexes = [connections[using].get_unified_index().get_index(Note) for using in connections.connections_info]
+
+        for index in indexes:
+            index.should_update = lambda instance, **kwargs: instance.author != 'Bot'
+
+        try:
+            Note.objects.create(
+                title='A test note',
+                content='Because everyone loves test data.',
+                author='Bot'
+            )
+            self.assertEqual(len(self.queue), 0)
+
+            Note.objects.create(
+                title='Another test note',
+                content='More test data.',
+                author='Daniel'
+            )
+            self.assertEqual(len(self.queue), 1)
+        finally:
+            for index in indexes:
+                del index.should_update
+
+    def test_update_fields(self):
+        note = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        self.assertEqual(len(self.queue), 1)
+
+        # Off by default.
+        note.save(update_fields=['author'])
+        self.assertEqual(len(self.queue), 2)
+
+        with self.settings(SEARCH_QUEUE_CHECK_UPDATE_FIELDS=True):
+            # The index is only built from ``content``.
+            note.save(update_fields=['author'])
+            self.assertEqual(len(self.queue), 2)
+
+            note.save(update_fields=['author', 'content'])
+            self.assertEqual(len(self.queue), 3)
+
+            note.save()
+            self.assertEqual(len(self.queue), 4)
+
     def test_complex(self):
         self.assertEqual(len(self.queue), 0)
 
@@ -168,13 +255,198 @@ class QueuedSearchIndexTestCase(TestCase):
 
         self.assertEqual(messages, [u'update:tests.note.1', u'update:tests.note.2', u'delete:tests.note.1', u'update:tests.note.3', u'update:tests.note.3', u'delete:tests.note.3'])
 
+    @skipUnless(hasattr(TestCase, 'captureOnCommitCallbacks'), "Without on_commit, messages are written straight away.")
+    def test_buffered_until_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            note1 = Note.objects.create(
+                title='A test note',
+                content='Because everyone loves test data.',
+                author='Daniel'
+            )
+            note1.title = 'A test note, revised'
+            note1.save()
+            note2 = Note.objects.create(
+                title='Another test note',
+                content='More test data.',
+                author='Daniel'
+            )
+            note2.delete()
+
+            # Nothing's written until the transaction commits.
+            self.assertEqual(len(self.queue), 0)
+
+        # Then only the last action on each object is.
+        messages = []
+
+        try:
+            while True:
+                messages.append(self.queue.read())
+        except QueueException:
+            # We're out of queued bits.
+            pass
+
+        self.assertEqual(sorted(messages), [u'delete:tests.note.2', u'update:tests.note.1'])
+
+    @skipUnless(hasattr(TestCase, 'captureOnCommitCallbacks'), "Without on_commit, messages are written straight away.")
+    def test_buffered_savepoint_rolled_back(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            note1 = Note.objects.create(
+                title='A test note',
+                content='Because everyone loves test data.',
+                author='Daniel'
+            )
+
+            try:
+                with transaction.atomic():
+                    note1.delete()
+                    raise ValueError("Changed our mind.")
+            except ValueError:
+                pass
+
+            note2 = Note.objects.create(
+                title='Another test note',
+                content='More test data.',
+                author='Daniel'
+            )
+
+        # The delete went with its savepoint.
+        messages = []
+
+        try:
+            while True:
+                messages.append(self.queue.read())
+        except QueueException:
+            # We're out of queued bits.
+            pass
+
+        self.assertEqual(sorted(messages), [u'update:tests.note.%s' % note1.pk, u'update:tests.note.%s' % note2.pk])
+
+    def test_flush_buffered(self):
+        # What a transaction leaves buffered, last action per object (see
+        # ``test_buffered_until_commit``), is written in one go.
+        signal_processor.flush({
+            'tests.note.1': 'update',
+            'tests.note.2': 'delete',
+            ('cascade', 'tests.author.1'): 'cascade',
+        })
+
+        messages = []
+
+        try:
+            while True:
+                messages.append(self.queue.read())
+        except QueueException:
+            # We're out of queued bits.
+            pass
+
+        self.assertEqual(sorted(messages), [u'cascade:tests.author.1', u'delete:tests.note.2', u'update:tests.note.1'])
+
+    def test_cascade_enqueued(self):
+        author = Author.objects.create(name='Daniel')
+        book = Book.objects.create(title='A test book', author=author)
+        tag = Tag.objects.create(name='unindexed')
+
+        # The author isn't indexed, but its books' documents depend on it.
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(self.queue.read(), 'cascade:tests.author.%s' % author.pk)
+        self.assertEqual(self.queue.read(), 'update:tests.book.%s' % book.pk)
+
+    def test_cascade_update_fields(self):
+        author = Author.objects.create(name='Daniel')
+        self.assertEqual(self.queue.read(), 'cascade:tests.author.%s' % author.pk)
+
+        # Off by default.
+        author.save(update_fields=['email'])
+        self.assertEqual(len(self.queue), 1)
+
+        with self.settings(SEARCH_QUEUE_CHECK_UPDATE_FIELDS=True):
+            # Books' documents only include the author's ``name``.
+            author.save(update_fields=['email'])
+            self.assertEqual(len(self.queue), 1)
+
+            author.save(update_fields=['name'])
+            self.assertEqual(len(self.queue), 2)
+
+    def test_spooled(self):
+        path = tempfile.mkdtemp()
+
+        with self.settings(SEARCH_QUEUE_SPOOL_PATH=path, SEARCH_QUEUE_SPOOL_INTERVAL=60):
+            # Started up front, so the forwarder's waiting by the time we save.
+            spool = get_spool()
+
+            note1 = Note.objects.create(
+                title='A test note',
+                content='Because everyone loves test data.',
+                author='Daniel'
+            )
+            note1.delete()
+
+            # It's only been spooled so far.
+            self.assertEqual(len(self.queue), 0)
+
+            self.assertEqual(spool.forward(), 2)
+            self.assertEqual(len(self.queue), 2)
+            self.assertEqual(self.queue.read(), 'update:tests.note.1')
+            self.assertEqual(self.queue.read(), 'delete:tests.note.1')
+            # Once everything's sent, the spool starts afresh.
+            self.assertEqual(os.path.getsize(spool.spool_path), 0)
+            spool.stop()
+
+    def test_spooled_packed(self):
+        path = tempfile.mkdtemp()
+
+        with self.settings(SEARCH_QUEUE_SPOOL_PATH=path, SEARCH_QUEUE_SPOOL_INTERVAL=60, SEARCH_QUEUE_PACK_MESSAGES=True):
+            spool = get_spool()
+
+            note1 = Note.objects.create(
+                title='A test note',
+                content='Because everyone loves test data.',
+                author='Daniel'
+            )
+            note2 = Note.objects.create(
+                title='Another test note',
+                content='More test data.',
+                author='Daniel'
+            )
+            note1.save()
+
+            # Each save is spooled on its own, but they're sent packed.
+            self.assertEqual(spool.forward(), 3)
+            self.assertEqual(len(self.queue), 1)
+            self.assertEqual(parse_message(self.queue.read()), [
+                ('update', 'tests.note.%s' % note1.pk, 0, None),
+                ('update', 'tests.note.%s' % note2.pk, 0, None),
+            ])
+            spool.stop()
+
+    def test_spool_adopts_dead_processes(self):
+        path = tempfile.mkdtemp()
+        spool = Spool(path)
+        spool.open()
+
+        # A process that's died with a message it didn't get to send & one it
+        # was part way through writing.
+        dead = subprocess.Popen([sys.executable, '-c', ''])
+        dead.wait()
+        dead_path = os.path.join(path, 'spool-%d.log' % dead.pid)
+
+        with open(dead_path, 'w') as dead_file:
+            dead_file.write('%s\tupdate:tests.note.1\n%s\tupdate:tests.no' % (get_queue_name(), get_queue_name()))
+
+        spool.adopt()
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.read(), 'update:tests.note.1')
+        self.assertEqual(os.listdir(path), [os.path.basename(spool.spool_path)])
+        spool.stop()
+
 
 class ProcessSearchQueueTestCase(TestCase):
     def setUp(self):
         super(ProcessSearchQueueTestCase, self).setUp()
 
-        # Nuke the queue.
+        # Nuke the queue (& the signal processor's hold on it).
         queues.delete_queue(get_queue_name())
+        signal_processor.close_queues()
 
         # Nuke the index.
         call_command('clear_index', interactive=False, verbosity=0)
@@ -182,6 +454,10 @@ class ProcessSearchQueueTestCase(TestCase):
         # Get a queue connection so we can poke at it.
         self.queue = queues.Queue(get_queue_name())
 
+        # Nuke the dead letters too.
+        queues.delete_queue(get_dead_letter_queue_name())
+        self.dead_letters = queues.Queue(get_dead_letter_queue_name())
+
         # Clear out and capture log messages.
         AssertableHandler.stowed_messages = []
 
@@ -208,6 +484,153 @@ class ProcessSearchQueueTestCase(TestCase):
         self.psqc.process_message('just plain wrong')
         self.assertEqual(self.psqc.actions, {'update': set(['tests.note.2']), 'delete': set(['tests.note.1'])})
 
+    def test_process_packed_message(self):
+        messages = pack_messages([
+            ('update', 'tests.note.1'),
+            ('update', 'tests.note.2'),
+            ('delete', 'tests.note.3'),
+            ('update', 'tests.note.3'),
+            ('delete', 'tests.note.4'),
+        ])
+        # Coalesced, with the last action winning.
+        self.assertEqual(messages, ['@delete/tests.note/4;update/tests.note/1,2,3'])
+
+        self.assertEqual(self.psqc.process_message(messages[0]), 4)
+        self.assertEqual(self.psqc.actions, {'update': set(['tests.note.1', 'tests.note.2', 'tests.note.3']), 'delete': set(['tests.note.4'])})
+
+        # Legacy messages still mix in fine.
+        self.psqc.process_message('update:tests.note.4')
+        self.assertEqual(self.psqc.actions, {'update': set(['tests.note.1', 'tests.note.2', 'tests.note.3', 'tests.note.4']), 'delete': set([])})
+
+        self.assertEqual(self.psqc.process_message('@update/tests.note'), 0)
+        self.assertEqual(self.psqc.process_message('@zbm9wZQ=='), 0)
+
+    def test_pack_messages(self):
+        pairs = [('update', 'tests.note.%s' % pk) for pk in range(1200)]
+        messages = pack_messages(pairs, size=500)
+        self.assertEqual(len(messages), 3)
+        # Big enough to be worth compressing.
+        self.assertTrue(messages[0].startswith('@z'))
+
+        unpacked = []
+
+        for message in messages:
+            unpacked.extend([(action, obj_identifier) for action, obj_identifier, attempts, first_seen in parse_message(message)])
+
+        self.assertEqual(unpacked, pairs)
+
+        # Nothing to group an identifier without a model path by.
+        self.assertEqual(pack_messages([('update', 'wtfmate')]), ['update:wtfmate'])
+
+        # Nor are pks that aren't integers packed, as they could hold what
+        # packed messages are split on.
+        messages = pack_messages([('update', 'tests.note.1'), ('update', 'tests.slug.a/b,c;d'), ('delete', 'tests.note.2')])
+        self.assertEqual(messages, ['update:tests.slug.a/b,c;d', '@delete/tests.note/2;update/tests.note/1'])
+        self.assertEqual(parse_message(messages[0]), [('update', 'tests.slug.a/b,c;d', 0, None)])
+
+    def test_identifier_set(self):
+        identifiers = IdentifierSet(['tests.note.1', 'tests.note.07', 'tests.note.1', 'broken'])
+        self.assertEqual(len(identifiers), 3)
+        self.assertTrue('tests.note.1' in identifiers)
+        self.assertTrue('tests.note.07' in identifiers)
+        # Leading zeros are kept, so these are different objects.
+        self.assertFalse('tests.note.7' in identifiers)
+        self.assertEqual(identifiers, set(['tests.note.1', 'tests.note.07', 'broken']))
+
+        # Grouped by model, with pks as ints where they are.
+        self.assertEqual(identifiers.object_paths(), ['tests.note'])
+        self.assertEqual(identifiers.pks('tests.note'), set([1, '07']))
+        self.assertEqual(identifiers.unparseable(), set(['broken']))
+
+        # Only ASCII digits make an int. Other Unicode digits are left be.
+        identifiers.add(u'tests.note.\xb2')
+        identifiers.add(u'tests.note.\u0663')
+        self.assertEqual(identifiers.pks('tests.note'), set([1, '07', u'\xb2', u'\u0663']))
+        identifiers.discard(u'tests.note.\xb2')
+        identifiers.discard(u'tests.note.\u0663')
+
+        identifiers.remove('tests.note.07')
+        identifiers.discard('broken')
+        identifiers.discard('tests.note.2')
+        self.assertEqual(identifiers, set(['tests.note.1']))
+        self.assertRaises(KeyError, identifiers.remove, 'tests.note.2')
+
+        # Identifiers can be split up once & looked up by that.
+        key = split_identifier('tests.note.3')
+        self.assertEqual(key, ('tests.note', 3))
+        self.assertEqual(split_identifier('broken'), (None, 'broken'))
+        self.assertFalse(key in identifiers)
+        identifiers.add(key)
+        self.assertTrue(key in identifiers)
+        self.assertTrue('tests.note.3' in identifiers)
+        identifiers.discard(key)
+        self.assertEqual(identifiers, set(['tests.note.1']))
+
+    def test_cascades(self):
+        author = Author.objects.create(name='Daniel')
+        book1 = Book.objects.create(title='A test book', author=author)
+        book2 = Book.objects.create(title='Another test book', author=author)
+        other_author = Author.objects.create(name='Joe')
+        book3 = Book.objects.create(title='Final test book', author=other_author)
+        call_command('process_search_queue')
+        self.assertEqual(SearchQuerySet().models(Book).count(), 3)
+
+        author.name = 'Daniel Lindsley'
+        author.save()
+        self.assertEqual(len(self.queue), 1)
+
+        self.psqc.batchsize = 10
+        self.psqc.process_message(self.queue.read())
+        self.psqc.process_message('delete:tests.book.%s' % book2.pk)
+        self.assertEqual(self.psqc.cascades, set(['tests.author.%s' % author.pk]))
+
+        # Only the author's books are updated, leaving the one being deleted
+        # alone.
+        self.psqc.handle_cascades()
+        self.assertEqual(self.psqc.actions, {'update': set(['tests.book.%s' % book1.pk]), 'delete': set(['tests.book.%s' % book2.pk])})
+        self.assertFalse(self.psqc.cascades)
+
+        # Cascades don't cancel out updates when packed.
+        self.assertEqual(pack_messages([('update', 'tests.author.1'), ('cascade', 'tests.author.1')]), ['@cascade/tests.author/1;update/tests.author/1'])
+
+    def test_cascades_capped(self):
+        author = Author.objects.create(name='Daniel')
+        books = [Book.objects.create(title='Book %d' % i, author=author) for i in range(3)]
+        queues.delete_queue(get_queue_name())
+        signal_processor.close_queues()
+        self.queue = queues.Queue(get_queue_name())
+
+        # Only room for one more in the window.
+        self.psqc.window_size = 2
+        self.psqc.batchsize = 1
+        self.psqc.process_message('update:tests.note.1')
+        self.psqc.process_message('cascade:tests.author.%s' % author.pk)
+        self.psqc.handle_cascades()
+
+        self.assertEqual(len(self.psqc.actions['update']), 2)
+        self.assertFalse(self.psqc.cascades)
+
+        # The rest are requeued, for later windows.
+        self.assertEqual(len(self.queue), 2)
+        requeued = set([self.queue.read(), self.queue.read()])
+        cascaded = set(['update:tests.book.%s' % book.pk for book in books])
+        self.assertEqual(len(requeued), 2)
+        self.assertTrue(requeued < cascaded)
+        self.assertEqual(cascaded - requeued, set(['update:%s' % obj_identifier for obj_identifier in self.psqc.actions['update'] if obj_identifier.startswith('tests.book.')]))
+
+    def test_get_dependents(self):
+        unified_index = UnifiedIndex()
+        dependents = get_dependents(unified_index)
+        self.assertEqual(list(dependents.keys()), [Author])
+        self.assertEqual([(type(index), path) for index, path in dependents[Author]], [(BookIndex, 'author')])
+
+        # Only worked out again once the unified index has been rebuilt.
+        self.assertTrue(get_dependents(unified_index) is dependents)
+        unified_index.build()
+        rebuilt = get_dependents(unified_index)
+        self.assertFalse(rebuilt is dependents)
+        self.assertTrue(rebuilt[Author][0][0] is unified_index.get_index(Book))
+
     def test_split_obj_identifier(self):
         self.assertEqual(self.psqc.split_obj_identifier('tests.note.1'), ('tests.note', '1'))
         self.assertEqual(self.psqc.split_obj_identifier('myproject.tests.note.73'), ('myproject.tests.note', '73'))
@@ -287,31 +710,40 @@ class ProcessSearchQueueTestCase(TestCase):
         self.assertEqual(SearchQuerySet().all().count(), 1)
 
     def test_requeuing(self):
-        self.assertEqual(len(self.queue), 0)
-
         note1 = Note.objects.create(
             title='A test note',
             content='Because everyone loves test data.',
             author='Daniel'
         )
-
-        self.assertEqual(len(self.queue), 1)
-
-        # Write a failed message.
-        self.queue.write('update:tests.note.abc')
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
         self.assertEqual(len(self.queue), 2)
 
         self.assertEqual(AssertableHandler.stowed_messages, [])
 
+        def unreachable(command, *args, **kwargs):
+            batches.append(args)
+            raise IOError("Connection refused")
+
+        batches = []
+        update_batch = ProcessSearchQueueCommand.update_batch
+        ProcessSearchQueueCommand.update_batch = unreachable
+
         try:
-            # Call the command, which will fail.
-            call_command('process_search_queue')
+            # Call the command, which will fail. The backend can't be
+            # reached, so the batch is requeued rather than dead lettered.
+            call_command('process_search_queue', retries=0)
             self.fail("The command ran successfully, which is incorrect behavior in this case.")
-        except:
-            # We don't care that it failed. We just want to examine the state
-            # of things afterward.
+        except IOError:
             pass
+        finally:
+            ProcessSearchQueueCommand.update_batch = update_batch
 
+        # The batch wasn't split up to find the culprit.
+        self.assertEqual(len(batches), 1)
         self.assertEqual(len(self.queue), 2)
 
         # Pull the whole queue.
@@ -324,63 +756,585 @@ class ProcessSearchQueueTestCase(TestCase):
             # We're out of queued bits.
             pass
 
-        self.assertEqual(messages, [u'update:tests.note.1', 'update:tests.note.abc'])
+        # Requeued as they were, without using up any attempts.
+        self.assertEqual(sorted(messages), ['update:tests.note.%s' % note1.pk, 'update:tests.note.%s' % note2.pk])
         self.assertEqual(len(self.queue), 0)
+        self.assertEqual(len(self.dead_letters), 0)
 
-        self.assertEqual(AssertableHandler.stowed_messages, [
-            'Starting to process the queue.',
-            u"Processing message 'update:tests.note.1'...",
-            u"Saw 'update' on 'tests.note.1'...",
-            u"Added 'tests.note.1' to the update list.",
-            "Processing message 'update:tests.note.abc'...",
-            "Saw 'update' on 'tests.note.abc'...",
-            "Added 'tests.note.abc' to the update list.",
-            'Queue consumed.',
-            "Exception seen during processing: invalid literal for int() with base 10: 'abc'",
+        self.assertEqual(AssertableHandler.stowed_messages[-3:], [
+            'Exception seen during processing: Connection refused',
             'Requeuing unprocessed messages.',
-            'Requeued 2 updates and 0 deletes.'
+            'Requeued 2 updates and 0 deletes.',
         ])
 
-        # Start over.
+    def test_isolating_transport_error(self):
+        def run_task(task):
+            raise IOError("Connection refused")
+
+        self.psqc.run_task = run_task
+
+        # Even a batch of one isn't blamed for an outage.
+        task = ('update', 'tests.note', ['1'], 0, 1)
+        self.assertRaises(IOError, self.psqc.isolate_failures, task, IOError("Connection refused"))
+        self.assertEqual(self.psqc.attempts, {})
+        self.assertEqual(len(self.dead_letters), 0)
+
+        # Nor is a half of a bigger batch.
+        task = ('update', 'tests.note', ['1', '2'], 0, 2)
+        self.assertRaises(IOError, self.psqc.isolate_failures, task, ValueError("Bad request."))
+        self.assertEqual(self.psqc.attempts, {})
+        self.assertEqual(self.psqc.processed_updates, set([]))
+
+    def test_isolating_failures_probe(self):
+        tasks = []
+
+        def run_task(task):
+            tasks.append(task)
+            raise ValueError("Bad request.")
+
+        self.psqc.run_task = run_task
+        self.psqc.max_attempts = 3
+        task = ('update', 'tests.note', ['1', '2', '3', '4'], 0, 4)
+
+        # Both halves fail just like the batch, so it's requeued as a whole
+        # with its attempts bumped, rather than narrowed down.
+        self.assertRaises(ValueError, self.psqc.isolate_failures, task, ValueError("Bad request."))
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(self.psqc.attempts['tests.note.1'][0], 1)
+        self.assertEqual(self.psqc.attempts['tests.note.4'][0], 1)
+        self.assertEqual(len(self.dead_letters), 0)
+
+        # Until the last attempt, when it's narrowed down after all.
+        self.psqc.attempts['tests.note.1'] = (2, self.psqc.window_started)
+        del tasks[:]
+        self.psqc.isolate_failures(task, ValueError("Bad request."))
+        self.assertEqual(len(tasks), 6)
+        self.assertEqual(len(self.dead_letters), 1)
+        self.assertEqual(self.psqc.processed_updates, set(['tests.note.1', 'tests.note.2', 'tests.note.3', 'tests.note.4']))
+
+    def test_isolating_failures(self):
         note1 = Note.objects.create(
             title='A test note',
             content='Because everyone loves test data.',
             author='Daniel'
         )
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        note3 = Note.objects.create(
+            title='Final test note',
+            content='The test data. All done.',
+            author='Joe'
+        )
+        note3.delete()
+
+        # Write failed messages.
+        self.queue.write('update:tests.note.abc')
+        self.queue.write('delete:tests.note.xyz')
+        self.assertEqual(len(self.queue), 6)
+
+        # The bad messages don't stop the good ones from being processed.
+        call_command('process_search_queue', max_attempts=1)
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(SearchQuerySet().all().count(), 2)
+
+        # The bad ones are dead lettered, along with their errors.
+        dead_letters = []
+
+        try:
+            while True:
+                dead_letters.append(json.loads(self.dead_letters.read()))
+        except QueueException:
+            # We're out of queued bits.
+            pass
 
+        dead_letters.sort(key=lambda dead_letter: dead_letter['identifier'])
+
+        for dead_letter in dead_letters:
+            self.assertTrue(dead_letter.pop('first_seen') is not None)
+
+        self.assertEqual(dead_letters, [
+            {
+                'action': 'update',
+                'identifier': 'tests.note.abc',
+                'attempts': 1,
+                'error': "invalid literal for int() with base 10: 'abc'",
+            },
+            {
+                'action': 'delete',
+                'identifier': 'tests.note.xyz',
+                'attempts': 1,
+                'error': "Provided string 'tests.note.xyz' is not a valid identifier.",
+            },
+        ])
+        self.assertTrue("Sending 'update:tests.note.abc' to the dead letter queue after 1 attempts: invalid literal for int() with base 10: 'abc'" in AssertableHandler.stowed_messages)
+
+    def test_failures_requeued_until_max_attempts(self):
+        note1 = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        self.queue.write('update:tests.note.abc')
+
+        call_command('process_search_queue', max_attempts=2)
+
+        # The first failure goes back on the queue, with its attempts.
         self.assertEqual(len(self.queue), 1)
+        self.assertEqual(len(self.dead_letters), 0)
+        message = self.queue.read()
+        envelope = json.loads(message)
+        self.assertEqual(envelope['action'], 'update')
+        self.assertEqual(envelope['identifier'], 'tests.note.abc')
+        self.assertEqual(envelope['attempts'], 1)
+
+        # Alongside a good object, which is still processed.
+        note1.save()
+        self.queue.write(message)
+        call_command('process_search_queue', max_attempts=2)
+
+        # The second failure is the last.
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(len(self.dead_letters), 1)
+        dead_letter = json.loads(self.dead_letters.read())
+        self.assertEqual(dead_letter['attempts'], 2)
+        self.assertEqual(dead_letter['first_seen'], envelope['first_seen'])
+
+    def test_search_dead_letters(self):
+        self.dead_letters.write(json.dumps({
+            'action': 'update',
+            'identifier': 'tests.note.1',
+            'attempts': 5,
+            'first_seen': 1381234567.8,
+            'error': 'Oops.',
+        }))
+        self.dead_letters.write(json.dumps({
+            'action': 'delete',
+            'identifier': 'tests.note.2',
+            'attempts': 5,
+            'first_seen': 1381234567.8,
+            'error': 'Oops.',
+        }))
+        # Not dead letters, but they mustn't be lost either.
+        self.dead_letters.write('Not JSON.')
+        self.dead_letters.write(json.dumps(['update', 'tests.note.3']))
+        self.dead_letters.write(json.dumps({'identifier': 'tests.note.4'}))
+
+        # Inspecting them leaves them where they are.
+        call_command('search_dead_letters', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(len(self.dead_letters), 5)
+        self.assertEqual(len(self.queue), 0)
+
+        call_command('search_dead_letters', replay=True, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(len(self.dead_letters), 3)
+
+        # Pull the whole queue.
+        messages = []
+
+        try:
+            while True:
+                messages.append(self.queue.read())
+        except QueueException:
+            # We're out of queued bits.
+            pass
+
+        self.assertEqual(messages, ['update:tests.note.1', 'delete:tests.note.2'])
 
+    def test_missing_instances(self):
+        note1 = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
         note2 = Note.objects.create(
             title='Another test note',
+            content='More test data.',
+            author='Daniel'
+        )
+
+        # Write a message for something that isn't in the database.
+        self.queue.write('update:tests.note.99')
+        self.assertEqual(len(self.queue), 3)
+
+        call_command('process_search_queue', batchsize=2)
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertTrue("Couldn't load model instance with pk #99. Somehow it went missing?" in AssertableHandler.stowed_messages)
+        self.assertEqual(SearchQuerySet().all().count(), 2)
+
+    def test_partitioned_processing(self):
+        partition_queues = []
+
+        for partition in range(2):
+            queues.delete_queue(get_queue_name(partition))
+            partition_queues.append(queues.Queue(get_queue_name(partition)))
+
+        signal_processor.close_queues()
+
+        with self.settings(SEARCH_QUEUE_PARTITIONS=2):
+            expected = [0, 0]
+
+            for i in range(6):
+                note = Note.objects.create(
+                    title='Note #%d' % i,
+                    content='Partitioned test data.',
+                    author='Daniel'
+                )
+                expected[get_partition(get_identifier(note))] += 1
+
+            # Nothing goes to the unpartitioned queue.
+            self.assertEqual(len(self.queue), 0)
+            self.assertEqual([len(queue) for queue in partition_queues], expected)
+
+            call_command('process_search_queue', partition='0')
+            self.assertEqual([len(queue) for queue in partition_queues], [0, expected[1]])
+            self.assertEqual(SearchQuerySet().all().count(), expected[0])
+
+            call_command('process_search_queue', partition='1')
+            self.assertEqual([len(queue) for queue in partition_queues], [0, 0])
+            self.assertEqual(SearchQuerySet().all().count(), 6)
+
+            self.assertRaises(CommandError, call_command, 'process_search_queue', partition='2')
+
+        self.assertRaises(CommandError, call_command, 'process_search_queue', partition='0')
+
+    def test_routed_processing(self):
+        queues.delete_queue(get_queue_name(route='slow'))
+        signal_processor.close_queues()
+        slow_queue = queues.Queue(get_queue_name(route='slow'))
+        routes = {
+            'default': {'share': 0.75},
+            'slow': {'models': ['tests.note'], 'priority': -1, 'share': 0.25},
+        }
+
+        with self.settings(SEARCH_QUEUE_ROUTES=routes):
+            note1 = Note.objects.create(
+                title='A test note',
+                content='Because everyone loves test data.',
+                author='Daniel'
+            )
+            note2 = Note.objects.create(
+                title='Another test note',
+                content='More test data.',
+                author='Daniel'
+            )
+
+            # Notes are routed to their own queue.
+            self.assertEqual(len(self.queue), 0)
+            self.assertEqual(len(slow_queue), 2)
+
+            call_command('process_search_queue', route='slow')
+            self.assertEqual(len(slow_queue), 0)
+            self.assertEqual(SearchQuerySet().all().count(), 2)
+
+            self.assertRaises(CommandError, call_command, 'process_search_queue', route='nope')
+
+            # Higher priority routes are read first, each limited to its share
+            # of the window while the others have messages.
+            for pk in range(6):
+                self.queue.write('update:tests.other.%d' % pk)
+                slow_queue.write('update:tests.note.%d' % pk)
+
+            self.psqc.window_size = 4
+            self.psqc.window_time = None
+            self.psqc.routes = self.psqc.setup_routes(None, [None])
+            self.assertEqual([route['name'] for route in self.psqc.routes], ['default', 'slow'])
+
+            self.assertFalse(self.psqc.consume())
+            self.assertEqual(sorted(self.psqc.actions['update']), ['tests.note.0', 'tests.other.0', 'tests.other.1', 'tests.other.2'])
+            self.psqc.reset()
+
+            self.assertFalse(self.psqc.consume())
+            self.assertEqual(sorted(self.psqc.actions['update']), ['tests.note.1', 'tests.other.3', 'tests.other.4', 'tests.other.5'])
+            self.psqc.reset()
+
+            # Once the rest run dry, they get the whole window.
+            self.assertFalse(self.psqc.consume())
+            self.assertEqual(sorted(self.psqc.actions['update']), ['tests.note.2', 'tests.note.3', 'tests.note.4', 'tests.note.5'])
+            self.psqc.reset()
+
+            self.assertTrue(self.psqc.consume())
+
+    def test_windowed_processing(self):
+        note1 = Note.objects.create(
+            title='A test note',
             content='Because everyone loves test data.',
             author='Daniel'
         )
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='More test data.',
+            author='Daniel'
+        )
+        note3 = Note.objects.create(
+            title='Final test note',
+            content='The test data. All done.',
+            author='Joe'
+        )
+        note1.delete()
+        self.assertEqual(len(self.queue), 4)
+
+        call_command('process_search_queue', window_size=2)
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(AssertableHandler.stowed_messages.count('Window consumed.'), 2)
+        self.assertEqual(AssertableHandler.stowed_messages.count('Queue consumed.'), 1)
+        self.assertEqual(SearchQuerySet().all().count(), 2)
 
+    def test_checkpointed_processing(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+        note1 = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='More test data.',
+            author='Daniel'
+        )
         self.assertEqual(len(self.queue), 2)
 
-        # Now delete it.
-        note2.delete()
+        # Stand in for a drain that's killed after reading the queue, but
+        # before indexing anything.
+        self.psqc.checkpoint_path = checkpoint
+        self.psqc.process_message(self.queue.read())
+        self.psqc.process_message(self.queue.read())
+        self.psqc.checkpoint()
+        self.assertEqual(len(self.queue), 0)
+        self.assertTrue(os.path.exists(checkpoint))
 
-        # Write a failed message.
-        self.queue.write('delete:tests.note.abc')
-        self.assertEqual(len(self.queue), 4)
+        call_command('process_search_queue', checkpoint=checkpoint)
 
-        AssertableHandler.stowed_messages = []
-        self.assertEqual(AssertableHandler.stowed_messages, [])
+        self.assertTrue("Resumed 2 objects from '%s'." % checkpoint in AssertableHandler.stowed_messages)
+        self.assertEqual(SearchQuerySet().all().count(), 2)
+        # Once everything's processed, there's nothing left to resume.
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_catch_up(self):
+        state = os.path.join(tempfile.mkdtemp(), 'catch_up')
+        # Saves are only left to be caught up if every connection's index
+        # has an updated field.
+        indexes = [connections[using].get_unified_index().get_index(Note) for using in connections.connections_info]
+
+        for index in indexes:
+            index.get_updated_field = lambda: 'created'
 
         try:
-            # Call the command, which will fail again.
+            with self.settings(SEARCH_QUEUE_CATCH_UP_MODELS=['tests.note']):
+                # Nothing's there yet, so it'll catch up on everything.
+                call_command('process_search_queue', catch_up=state)
+                self.assertTrue(os.path.exists(state))
+
+                note1 = Note.objects.create(
+                    title='A test note',
+                    content='Because everyone loves test data.',
+                    author='Daniel',
+                    created=datetime.datetime(2013, 10, 1, 12, 0)
+                )
+                note2 = Note.objects.create(
+                    title='Another test note',
+                    content='More test data.',
+                    author='Daniel',
+                    created=datetime.datetime(2013, 10, 1, 12, 0)
+                )
+                note3 = Note.objects.create(
+                    title='Final test note',
+                    content='The test data. All done.',
+                    author='Joe',
+                    created=datetime.datetime(2013, 10, 2, 12, 0)
+                )
+                note3.delete()
+
+                # Saves aren't queued, only the delete is.
+                self.assertEqual(len(self.queue), 1)
+
+                call_command('process_search_queue', catch_up=state, batchsize=1)
+                self.assertEqual(len(self.queue), 0)
+                self.assertEqual(SearchQuerySet().all().count(), 2)
+
+                # Starting again, the overlap before where it left off is
+                # looked at again, once. After that, only what's changed since
+                # is found.
+                self.psqc.catch_up_path = state
+                self.psqc.batchsize = 10
+                self.psqc.setup_catch_up()
+                self.assertEqual(self.psqc.catch_up(), (2, True))
+                self.assertEqual(self.psqc.catch_up(), (0, True))
+                self.psqc.actions['update'].clear()
+
+                note1.created = datetime.datetime(2013, 10, 3, 12, 0)
+                note1.save()
+                self.assertEqual(self.psqc.catch_up(), (1, True))
+                self.assertEqual(self.psqc.actions['update'], set(['tests.note.%s' % note1.pk]))
+                self.psqc.actions['update'].clear()
+
+                # A change committed late, within the overlap, is still found.
+                # One from before it isn't.
+                note2.created = datetime.datetime(2013, 10, 3, 11, 59, 58)
+                note2.save()
+                note4 = Note.objects.create(
+                    title='A late note',
+                    content='Committed long after it was created.',
+                    author='Joe',
+                    created=datetime.datetime(2013, 10, 3, 11, 0)
+                )
+                self.assertEqual(self.psqc.catch_up(), (1, True))
+                self.assertEqual(self.psqc.actions['update'], set(['tests.note.%s' % note2.pk]))
+
+                # A model that's never been caught up starts from when the
+                # command started, less the overlap.
+                self.psqc.catch_up_started = datetime.datetime(2013, 10, 4, 12, 0)
+                self.assertEqual(self.psqc.start_catch_up('tests.note', indexes[0], 'created'), (datetime.datetime(2013, 10, 4, 11, 59, 55), None))
+        finally:
+            for index in indexes:
+                del index.get_updated_field
+
+    def test_prefetched_processing(self):
+        note1 = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='More test data.',
+            author='Daniel'
+        )
+        note3 = Note.objects.create(
+            title='Final test note',
+            content='The test data. All done.',
+            author='Joe'
+        )
+        note1.delete()
+        self.assertEqual(len(self.queue), 4)
+
+        call_command('process_search_queue', window_size=2, prefetch=1)
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(SearchQuerySet().all().count(), 2)
+
+    def test_prefetching_queue(self):
+        for pk in range(4):
+            self.queue.write('update:tests.note.%d' % pk)
+
+        prefetching = PrefetchingQueue(self.queue, 2)
+        self.assertEqual(prefetching.read(), 'update:tests.note.0')
+
+        # Anything read ahead goes back on the queue.
+        prefetching.close()
+        messages = [self.queue.read() for i in range(len(self.queue))]
+        self.assertEqual(sorted(messages), ['update:tests.note.1', 'update:tests.note.2', 'update:tests.note.3'])
+
+        prefetching = PrefetchingQueue(self.queue, 2)
+        self.assertEqual(prefetching.read(), None)
+        prefetching.close()
+
+    def test_metrics(self):
+        RecordingMetrics.recorded = []
+        note1 = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='More test data.',
+            author='Daniel'
+        )
+        note2.delete()
+        self.queue.write('update:tests.note.99')
+
+        with self.settings(SEARCH_QUEUE_METRICS='tests.tests.RecordingMetrics'):
             call_command('process_search_queue')
-            self.fail("The command ran successfully, which is incorrect behavior in this case.")
-        except:
-            # We don't care that it failed. We just want to examine the state
-            # of things afterward.
-            pass
 
-        # Everything but the bad bit of data should have processed.
-        self.assertEqual(len(self.queue), 1)
+        counts = {}
+
+        for name, value, labels in RecordingMetrics.recorded:
+            counts[name] = counts.get(name, 0) + value
+
+        self.assertEqual(counts['messages_read'], 4)
+        self.assertEqual(counts['coalesced'], 1)
+        self.assertEqual(counts['fetched'], 1)
+        self.assertEqual(counts['missing'], 1)
+        self.assertEqual(counts['indexed'], 1)
+        self.assertEqual(counts['deleted'], 1)
+        self.assertTrue(('indexed', 1, {'model': 'tests.note'}) in RecordingMetrics.recorded)
+
+    def test_prometheus_textfile_metrics(self):
+        path = os.path.join(tempfile.mkdtemp(), 'queued_search.prom')
+        metrics = PrometheusTextfileMetrics(path)
+        metrics.incr('indexed', 2, model='tests.note')
+        metrics.incr('indexed', model='tests.note')
+        metrics.gauge('queue_depth', 7, route='default')
+        metrics.timing('send', 0.5, model='tests.note')
+        metrics.flush()
+
+        with open(path) as prom_file:
+            lines = prom_file.read().splitlines()
+
+        self.assertEqual(lines, [
+            '# TYPE queued_search_indexed_total counter',
+            'queued_search_indexed_total{model="tests.note"} 3',
+            '# TYPE queued_search_queue_depth gauge',
+            'queued_search_queue_depth{route="default"} 7',
+            '# TYPE queued_search_send_seconds summary',
+            'queued_search_send_seconds_count{model="tests.note"} 1',
+            'queued_search_send_seconds_sum{model="tests.note"} 0.5',
+        ])
 
-        # Pull the whole queue.
+    def test_daemon(self):
+        note1 = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='More test data.',
+            author='Daniel'
+        )
+        self.assertEqual(len(self.queue), 2)
+
+        # Stand in for SIGTERM arriving once the queue has gone idle.
+        def stop(seconds):
+            self.psqc.shutting_down = True
+
+        self.psqc.sleep = stop
+        self.psqc.handle_noargs(daemon=True, using='default')
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertTrue('Shutting down.' in AssertableHandler.stowed_messages)
+        self.assertEqual(SearchQuerySet().all().count(), 2)
+
+    def test_daemon_shutdown_requeues(self):
+        note1 = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='More test data.',
+            author='Daniel'
+        )
+        self.assertEqual(len(self.queue), 2)
+
+        # Stand in for SIGTERM arriving mid-window.
+        original_process_message = self.psqc.process_message
+
+        def process_then_stop(message):
+            processed = original_process_message(message)
+            self.psqc.shutting_down = True
+            return processed
+
+        self.psqc.process_message = process_then_stop
+        self.psqc.handle_noargs(daemon=True, using='default')
+
+        # The consumed message went back on the queue, behind the unread one.
         messages = []
 
         try:
@@ -390,28 +1344,278 @@ class ProcessSearchQueueTestCase(TestCase):
             # We're out of queued bits.
             pass
 
-        self.assertEqual(messages, ['delete:tests.note.abc'])
-        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(messages, [u'update:tests.note.2', u'update:tests.note.1'])
+        self.assertTrue('Requeued 1 updates and 0 deletes.' in AssertableHandler.stowed_messages)
+        self.assertEqual(SearchQuerySet().all().count(), 0)
+
+    def test_run_tasks_with_workers(self):
+        self.psqc.workers = 2
+        self.psqc.worker_type = 'thread'
+        # So the broken batch goes straight to the dead letter queue.
+        self.psqc.max_attempts = 1
+
+        def run_task(task):
+            action, object_path, items = task[:3]
+
+            if object_path == 'tests.broken':
+                raise ValueError("Broken batch.")
+
+            if action == 'update':
+                return (action, ["%s.%s" % (object_path, pk) for pk in items])
 
+            return (action, items)
+
+        self.psqc.run_task = run_task
+        self.psqc.start_workers()
+
+        try:
+            self.psqc.run_tasks([
+                ('update', 'tests.note', ['1', '2'], 0, 2),
+                ('update', 'tests.broken', ['1'], 0, 1),
+                ('delete', 'tests.note', ['tests.note.3'], 0, 1),
+            ])
+        finally:
+            self.psqc.stop_workers()
+
+        # Everything's marked as processed, including the broken batch,
+        # which has been dead lettered.
+        self.assertEqual(self.psqc.processed_updates, set(['tests.note.1', 'tests.note.2', 'tests.broken.1']))
+        self.assertEqual(self.psqc.processed_deletes, set(['tests.note.3']))
+        self.assertEqual(len(self.dead_letters), 1)
+
+    def test_run_tasks_with_process_workers(self):
+        note1 = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='More test data.',
+            author='Daniel'
+        )
+        self.psqc.workers = 2
+        self.psqc.worker_type = 'process'
+        self.psqc.start_workers()
+
+        try:
+            # Only one batch has anything to send, as Whoosh can't be written
+            # to from two processes at once.
+            self.psqc.run_tasks([
+                ('update', 'tests.note', [note1.pk, note2.pk], 0, 2),
+                ('update', 'tests.note', [note2.pk + 1], 0, 1),
+            ])
+        finally:
+            self.psqc.stop_workers()
+
+        self.assertEqual(self.psqc.processed_updates, set(['tests.note.%s' % note1.pk, 'tests.note.%s' % note2.pk]))
+        self.assertEqual(SearchQuerySet().all().count(), 2)
+
+    def test_resolve(self):
+        model_class, current_index = self.psqc.resolve('tests.note')
+        self.assertEqual(model_class, Note)
+        self.assertEqual(current_index.get_model(), Note)
+
+        # Failures are cached too, so they're only logged once.
+        self.assertEqual(self.psqc.resolve('tests.nope'), (None, None))
+        self.assertEqual(self.psqc.resolve('tests.nope'), (None, None))
         self.assertEqual(AssertableHandler.stowed_messages, [
-            'Starting to process the queue.',
-            u"Processing message 'update:tests.note.2'...",
-            u"Saw 'update' on 'tests.note.2'...",
-            u"Added 'tests.note.2' to the update list.",
-            u"Processing message 'update:tests.note.3'...",
-            u"Saw 'update' on 'tests.note.3'...",
-            u"Added 'tests.note.3' to the update list.",
-            u"Processing message 'delete:tests.note.3'...",
-            u"Saw 'delete' on 'tests.note.3'...",
-            u"Added 'tests.note.3' to the delete list.",
-            "Processing message 'delete:tests.note.abc'...",
-            "Saw 'delete' on 'tests.note.abc'...",
-            "Added 'tests.note.abc' to the delete list.",
-            'Queue consumed.',
-            u'Indexing 1 tests.note.',
-            '  indexing 1 - 1 of 1.',
-            u"Updated objects for 'tests.note': 2",
-            "Exception seen during processing: Provided string 'tests.note.abc' is not a valid identifier.",
-            'Requeuing unprocessed messages.',
-            'Requeued 0 updates and 1 deletes.'
+            "Could not load model from 'tests.nope'. Moving on...",
         ])
+
+    def test_multiple_connections(self):
+        note1 = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='More test data.',
+            author='Daniel'
+        )
+        note3 = Note.objects.create(
+            title='Final test note',
+            content='The test data. All done.',
+            author='Joe'
+        )
+        note3.delete()
+        self.assertEqual(len(self.queue), 4)
+
+        call_command('process_search_queue', using='default,shadow')
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(SearchQuerySet(using='default').all().count(), 2)
+        self.assertEqual(SearchQuerySet(using='shadow').all().count(), 2)
+
+    def test_update_objects_fallback(self):
+        note = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        index = connections['default'].get_unified_index().get_index(Note)
+        sent = []
+
+        class OtherBackend(object):
+            # One we can't send prepared documents to, so it prepares them
+            # itself.
+            def update(self, backend_index, instances):
+                sent.append([backend_index.full_prepare(instance)['text'] for instance in instances])
+
+        update_objects([OtherBackend()], index, [note])
+        self.assertEqual(sent, [[u'Because everyone loves test data.']])
+
+    def test_prepare_documents_in_threads(self):
+        notes = [Note.objects.create(title='Note %d' % i, content='Content %d' % i, author='Daniel') for i in range(20)]
+        index = connections['default'].get_unified_index().get_index(Note)
+        pool = ThreadPool(4)
+
+        try:
+            # Each thread prepares with the same index at once, without
+            # treading on the others.
+            prepared = pool.map(lambda note: prepare_documents(index, [note])[0]['text'], notes)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(prepared, ['Content %d' % i for i in range(20)])
+
+    def test_retry(self):
+        self.psqc.retry_backoff = 0.01
+        attempts = []
+
+        def flaky(value):
+            attempts.append(value)
+
+            if len(attempts) < 3:
+                raise IOError("Too many requests.")
+
+            return value
+
+        self.assertEqual(self.psqc.retry(flaky, 'sent'), 'sent')
+        self.assertEqual(len(attempts), 3)
+
+        # Once the retries run out, the error comes through.
+        self.psqc.retries = 1
+        attempts = []
+        self.assertRaises(IOError, self.psqc.retry, flaky, 'sent')
+        self.assertEqual(len(attempts), 2)
+
+        # Errors that'd only happen again aren't retried at all.
+        attempts = []
+
+        def broken(value):
+            attempts.append(value)
+            raise ValueError("[Reason: undefined field title]")
+
+        self.assertRaises(ValueError, self.psqc.retry, broken, 'sent')
+        self.assertEqual(len(attempts), 1)
+
+    def test_is_transport_error(self):
+        class ConnectionError(Exception):
+            pass
+
+        self.assertTrue(is_transport_error(IOError("Connection refused")))
+        self.assertTrue(is_transport_error(ConnectionError("Max retries exceeded")))
+        self.assertTrue(is_transport_error(Exception("Solr responded with an error (HTTP 503): [Reason: None]")))
+        self.assertFalse(is_transport_error(ValueError("invalid literal for int() with base 10: 'abc'")))
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(20)
+
+        # A second's worth goes straight through...
+        started = time.time()
+        limiter.acquire(20)
+        self.assertTrue(time.time() - started < 0.05)
+
+        # ...then it's held to the rate.
+        limiter.acquire(2)
+        self.assertTrue(time.time() - started >= 0.09)
+
+        limiter.slow_down()
+        self.assertEqual(limiter.rate, 10.0)
+
+        for i in range(10):
+            limiter.speed_up()
+
+        self.assertEqual(limiter.rate, 20.0)
+
+    def test_is_overload_error(self):
+        self.assertTrue(is_overload_error(IOError("Too many requests.")))
+        self.assertTrue(is_overload_error(Exception("TransportError(429, 'es_rejected_execution_exception')")))
+        self.assertTrue(is_overload_error(Exception("Non-200 status code: 503")))
+        self.assertTrue(is_overload_error(Exception("Solr responded with an error (HTTP 503): [Reason: None]")))
+        self.assertFalse(is_overload_error(Exception("[Reason: undefined field title]")))
+        # A status code on its own could be anything, like part of an
+        # identifier.
+        self.assertFalse(is_overload_error(Exception("Unable to prepare tests.note.503: 'NoneType' object has no attribute 'title'")))
+
+        # Errors that carry their status are taken at their word.
+        error = IOError("Slow down.")
+        error.status_code = 429
+        self.assertTrue(is_overload_error(error))
+
+    def test_rate_limited_processing(self):
+        self.assertRaises(CommandError, self.psqc.parse_rates, 'default:lots')
+        self.assertRaises(CommandError, self.psqc.parse_rates, '0')
+        self.assertEqual(self.psqc.parse_rates('default:50, shadow:5'), {'default': 50.0, 'shadow': 5.0})
+
+        note1 = Note.objects.create(
+            title='A test note',
+            content='Because everyone loves test data.',
+            author='Daniel'
+        )
+        note2 = Note.objects.create(
+            title='Another test note',
+            content='More test data.',
+            author='Daniel'
+        )
+
+        call_command('process_search_queue', batchsize=1, max_requests_per_second='1000')
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(SearchQuerySet().all().count(), 2)
+
+    def test_overload_slows_down(self):
+        self.psqc.retry_backoff = 0.01
+        self.psqc.limiters = self.psqc.setup_limiters(None, '100')
+        request_limiter = self.psqc.limiters['default'][1]
+        attempts = []
+
+        def overloaded():
+            attempts.append(True)
+
+            if len(attempts) < 2:
+                raise IOError("Service Unavailable")
+
+            return 'sent'
+
+        self.psqc.retry(overloaded, using='default', count=1)
+        # Halved on the 503, then partly recovered once it went through.
+        self.assertEqual(request_limiter.rate, 60.0)
+
+    def test_min_age(self):
+        self.psqc.min_age = 60
+        self.psqc.process_message('update:tests.note.1')
+        self.psqc.process_message('delete:tests.note.2')
+        self.psqc.seen_at['tests.note.2'] -= 120
+
+        self.assertTrue(self.psqc.has_pending())
+        self.assertTrue(self.psqc.has_mature())
+
+        held = self.psqc.hold_immature()
+        self.assertEqual(self.psqc.actions, {'update': set([]), 'delete': set(['tests.note.2'])})
+
+        self.psqc.restore(held)
+        self.assertEqual(self.psqc.actions, {'update': set(['tests.note.1']), 'delete': set(['tests.note.2'])})
+
+        # Only the mature delete is processed. The update waits.
+        self.psqc.flush()
+        self.assertEqual(self.psqc.actions, {'update': set(['tests.note.1']), 'delete': set([])})
+        self.assertFalse(self.psqc.has_mature())
+        self.assertTrue(self.psqc.until_mature() > 50)
+
+        # Unless it's forced.
+        self.psqc.flush(force=True)
+        self.assertFalse(self.psqc.has_pending())